@@ -0,0 +1,186 @@
+"""
+Runs dump variants against the local mock server and reports machine-readable results
+
+    python benchmark.py --books 200 --latency 0.05 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from urllib.request import urlopen
+
+import pack
+import mock_server
+import compression
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+VARIANTS = (
+    'sync_dump',
+    'async_dump',
+    'thread_dump',
+    'proc_dump',
+    'mixed_proc_async_dump',
+    'mixed_proc_thread_dump',
+    'mixed_thread_proc_async_dump',
+    'mixed_thread_proc_dump',
+)
+
+TEXT_FILE_NAMES = {'result.txt'} | {'result.txt' + suffix for suffix in compression.SUFFIXES}
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def tree_rss(pid):
+    """Resident bytes of a process and all its descendants, from /proc, None where there is no /proc"""
+    if not os.path.isdir('/proc'):
+        return None
+    children, rss = {}, {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'rb') as f:
+                stat = f.read()
+        except OSError:  # exited meanwhile
+            continue
+        fields = stat[stat.rindex(b')') + 2:].split()  # the name in parentheses may contain spaces
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss[int(entry)] = int(fields[21]) * PAGE_SIZE
+    total, pending = 0, [pid]
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, ()))
+    return total
+
+
+def server_stats(base_url, reset=False):
+    with urlopen(f"{base_url}_stats{'?reset=1' if reset else ''}") as response:
+        return json.load(response)
+
+
+def dump_stats(work_dir):
+    """Counts dumped books and bytes written by a variant"""
+    books, size = 0, 0
+    for dir_path, _, file_names in os.walk(work_dir):
+        for file_name in file_names:
+            if file_name in TEXT_FILE_NAMES:
+                books += 1
+            elif file_name == pack.PACK_FILE_NAME:
+                books += len(pack.PackReader(os.path.join(dir_path, file_name)).by_url)
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return books, size
+
+
+def run_variant(variant, base_url, timeout, env=None):
+    """Runs one variant in a clean working directory and measures it"""
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{variant}_")
+    env = dict(os.environ, **(env or {}), DUMP_SITE_BASE_URL=base_url, PYTHONPATH=REPO_DIR)
+    server_stats(base_url, reset=True)
+
+    timed_out = False
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, 'output.log'), 'wb') as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, f"{variant}.py")],
+            cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+        deadline = start + timeout
+        peak_rss = None
+        while True:
+            rss = tree_rss(process.pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.perf_counter() > deadline:
+                process.kill()
+                timed_out = True
+                pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            time.sleep(0.01)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    stats = server_stats(base_url)
+    books, dump_bytes = dump_stats(work_dir)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return {
+        'variant': variant,
+        'exit_code': process.returncode,
+        'timed_out': timed_out,
+        'wall_time': round(wall, 3),
+        'time_to_first_text': stats['first_text'] and round(stats['first_text'], 3),
+        'requests': stats['requests'],
+        'connections': stats['connections'],
+        'requests_per_connection': round(stats['requests'] / max(stats['connections'], 1), 2),
+        'errors': stats['errors'],
+        'requests_per_second': round(stats['requests'] / wall, 2),
+        'bytes_received': stats['bytes_sent'],
+        'mb_per_second': round(stats['bytes_sent'] / wall / 2 ** 20, 3),
+        'books_dumped': books,
+        'bytes_written': dump_bytes,
+        # all processes together, sampled while the variant runs; the largest single process as the kernel counts it
+        'peak_rss_mb': round((peak_rss or rusage.ru_maxrss * 1024) / 2 ** 20, 1),
+        'max_process_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'cpu_user': round(rusage.ru_utime, 3),
+        'cpu_system': round(rusage.ru_stime, 3),
+        'cpu_percent': round(100 * cpu / wall, 1),
+        'work_dir': work_dir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--variants', nargs='+', default=VARIANTS, choices=VARIANTS, metavar='VARIANT')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per variant')
+    parser.add_argument('--timeout', type=float, default=600, help='max seconds per run')
+    parser.add_argument('--output', help='write results as json to this file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep dump directories')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE', help='extra settings for variants')
+    mock_server.add_site_arguments(parser)
+    args = parser.parse_args()
+
+    mock_server.logger.setLevel('INFO')
+    server, base_url = mock_server.serve_in_thread(**mock_server.site_options(args))
+    logger.info(f"Mock server on {base_url}")
+
+    env = dict(item.split('=', 1) for item in args.env)
+    results = []
+    try:
+        for variant in args.variants:
+            for run in range(args.repeat):
+                result = run_variant(variant, base_url, args.timeout, env)
+                result['run'] = run
+                logger.info(
+                    f"{variant}: {result['wall_time']}s, first text {result['time_to_first_text']}s, "
+                    f"{result['requests_per_second']} req/s, "
+                    f"{result['connections']} connections, "
+                    f"{result['mb_per_second']} MB/s, {result['peak_rss_mb']} MB RSS, {result['cpu_percent']}% CPU, "
+                    f"{result['books_dumped']}/{args.books} books"
+                )
+                if not args.keep:
+                    shutil.rmtree(result.pop('work_dir'))
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report = {'site': mock_server.site_options(args), 'env': env, 'results': results}
+    if args.output:
+        with open(args.output, 'wt', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
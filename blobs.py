@@ -0,0 +1,138 @@
+"""
+Content-addressed blob store shared by daily dumps
+
+With `DUMP_OUTPUT=blobs` every dumped file is stored once under `DUMP_BLOB_DIR/ab/abcdef...` by the sha256
+of its bytes, and book directories hold hardlinks to the blobs. A file that did not change since an earlier dump
+costs a link instead of a copy: it is written to a temporary file, found in the store and removed, usually
+before the kernel writes it back. The store must be on the filesystem of the dumps.
+
+A blob is referenced by as many dumps as it has links beyond its own, so after old dump directories are removed
+
+    python blobs.py gc blobs
+
+deletes blobs no dump links to any more.
+"""
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+
+import metrics
+from logger import get_logger
+from settings import CHUNK_SIZE
+
+logger = get_logger(__name__)
+
+TMP_DIR_NAME = '.tmp'
+GC_MIN_AGE = 3600  # seconds, younger blobs may be about to get their first link
+
+blob_files = metrics.Counter(
+    'dump_blob_files_total', 'Files put into the blob store, new or linked', 'result', ('stored', 'deduplicated')
+)
+saved_bytes = metrics.Counter('dump_blob_saved_bytes_total', 'Bytes of deduplicated files not stored again')
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, TMP_DIR_NAME)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def temp_path(self, prefix='', suffix=''):
+        """New empty file to write a body to, on the filesystem of the store"""
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def link(self, path, target):
+        """Moves the file at `path` into the store unless it is there already, `target` becomes a hardlink to the blob"""
+        blob = self.blob_path(file_digest(path))
+        link = f"{target}.{os.getpid()}.tmp"
+        try:
+            os.link(blob, link)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.chmod(path, 0o444)  # shared by every dump linking it
+            os.replace(path, blob)  # an identical blob stored meanwhile is simply replaced
+            os.link(blob, link)
+            blob_files.inc(label='stored')
+        else:
+            blob_files.inc(label='deduplicated')
+            saved_bytes.inc(os.path.getsize(path))
+            os.remove(path)
+        os.replace(link, target)
+        return blob
+
+    def blobs(self):
+        for dir_name in os.listdir(self.root):
+            if dir_name == TMP_DIR_NAME or not os.path.isdir(os.path.join(self.root, dir_name)):
+                continue
+            for name in os.listdir(os.path.join(self.root, dir_name)):
+                yield os.path.join(self.root, dir_name, name)
+
+    def gc(self, min_age=GC_MIN_AGE, dry_run=False):
+        """Removes blobs without links from dumps and forgotten temporary files, returns their count and size"""
+        now = time.time()
+        removed, size = 0, 0
+        temporary = (os.path.join(self.tmp_dir, name) for name in os.listdir(self.tmp_dir))
+        for path in (*self.blobs(), *temporary):
+            stat = os.stat(path)
+            if stat.st_nlink > 1 or now - stat.st_mtime < min_age:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed += 1
+            size += stat.st_size
+        return removed, size
+
+    def usage(self):
+        """Blob count, their size and how much the dumps linking them would take as copies"""
+        blobs, size, linked = 0, 0, 0
+        for path in self.blobs():
+            stat = os.stat(path)
+            blobs += 1
+            size += stat.st_size
+            linked += stat.st_size * (stat.st_nlink - 1)
+        return blobs, size, linked
+
+
+def report():
+    if blob_files.value('stored') or blob_files.value('deduplicated'):
+        logger.info(
+            f"Blobs: {blob_files.value('stored')} stored, {blob_files.value('deduplicated')} deduplicated, "
+            f"{saved_bytes.value()} bytes not stored again"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('gc', 'usage'))
+    parser.add_argument('store', help='blob store directory, DUMP_BLOB_DIR of the dumps')
+    parser.add_argument('--min-age', type=float, default=GC_MIN_AGE, help='seconds, younger blobs are kept')
+    parser.add_argument('--dry-run', action='store_true', help='only count what gc would remove')
+    args = parser.parse_args()
+
+    store = BlobStore(args.store)
+    if args.command == 'gc':
+        removed, size = store.gc(args.min_age, args.dry_run)
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {removed} files, {size} bytes")
+    else:
+        blobs, size, linked = store.usage()
+        print(f"{blobs} blobs, {size} bytes stored, {linked} bytes linked from dumps")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+SQLite catalog of dumped books
+
+All dumps keep one `DUMP_CATALOG` (`catalog.sqlite` by default), one row per book with its about text,
+size and sha256 of result.txt, HTTP validators and when and how long the text was last fetched.
+`changed_at` moves only when the hash does, so `changed` finds the books that differ from the dumps of earlier days.
+`book_tags` has every tag a book was listed under.
+The coordinator is the only writer, rows are upserted in batches of `DUMP_CATALOG_BATCH_SIZE`, short transactions
+let the catalog be queried while a dump is running. No WAL, cluster hosts may share the file over the network.
+
+    python catalog.py catalog.sqlite biggest --limit 5
+    python catalog.py catalog.sqlite changed --since 2024-01-31
+    python catalog.py catalog.sqlite shared
+    python catalog.py catalog.sqlite sql "SELECT count(*), sum(size) FROM books"
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+
+from logger import get_logger
+from settings import CATALOG_BATCH_SIZE
+
+logger = get_logger(__name__)
+
+CATALOG_FILE_NAME = 'catalog.sqlite'
+FLUSH_INTERVAL = 1  # seconds, a partial batch is written on the next add after this
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    about TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL,
+    fetch_seconds REAL,
+    changed_at REAL
+);
+CREATE INDEX IF NOT EXISTS books_name ON books (name);
+CREATE INDEX IF NOT EXISTS books_size ON books (size);
+CREATE INDEX IF NOT EXISTS books_fetched_at ON books (fetched_at);
+CREATE INDEX IF NOT EXISTS books_changed_at ON books (changed_at);
+CREATE TABLE IF NOT EXISTS book_tags (
+    url TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (url, tag)
+);
+CREATE INDEX IF NOT EXISTS book_tags_tag ON book_tags (tag);
+"""
+
+
+def upsert(columns):
+    """Statement updating only `columns` of an existing row, `changed_at` follows a new sha256"""
+    updates = [f"{column} = excluded.{column}" for column in columns if column != 'url']
+    if 'sha256' in columns:
+        columns = columns + ('changed_at',)
+        updates.append(
+            "changed_at = CASE WHEN books.sha256 IS excluded.sha256 THEN books.changed_at ELSE excluded.changed_at END"
+        )
+    return (
+        f"INSERT INTO books ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT (url) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+class Catalog:
+    """Single writer, records are dicts with `url`, `name` and any other columns"""
+
+    def __init__(self, path, batch_size=CATALOG_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, timeout=30)  # cluster workers take turns writing
+        # the rollback journal works over network filesystems, WAL needs memory shared on one host
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pending = []
+        self.pending_tags = []
+        self.flushed = time.monotonic()
+        self.rows = 0
+        self.tags = 0
+
+    def add(self, record):
+        self.pending.append(record)
+        self.maybe_flush()
+
+    def tag(self, book_url, tag):
+        """Records that a book is listed under a tag"""
+        self.pending_tags.append((book_url, tag))
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        pending = len(self.pending) + len(self.pending_tags)
+        if pending >= self.batch_size or time.monotonic() - self.flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        batches = {}
+        for record in self.pending:
+            batches.setdefault(tuple(record), []).append(record)
+        with self.connection:
+            for columns, records in batches.items():
+                self.connection.executemany(upsert(columns), [
+                    tuple(record.values()) + ((record['fetched_at'],) if 'sha256' in columns else ())
+                    for record in records
+                ])
+            self.connection.executemany("INSERT OR IGNORE INTO book_tags (url, tag) VALUES (?, ?)", self.pending_tags)
+        self.rows += len(self.pending)
+        self.tags += len(self.pending_tags)
+        self.pending = []
+        self.pending_tags = []
+        self.flushed = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+        logger.info(f"Catalog: {self.rows} records upserted, {self.tags} tag memberships, {self.path}")
+
+
+QUERIES = {
+    'biggest': "SELECT name, size, url FROM books WHERE size IS NOT NULL ORDER BY size DESC LIMIT ?",
+    'recent': "SELECT name, datetime(fetched_at, 'unixepoch'), round(fetch_seconds, 3), url FROM books "
+              "WHERE fetched_at IS NOT NULL ORDER BY fetched_at DESC LIMIT ?",
+    'slowest': "SELECT name, round(fetch_seconds, 3), size, url FROM books "
+               "WHERE fetch_seconds IS NOT NULL ORDER BY fetch_seconds DESC LIMIT ?",
+    'changed': "SELECT name, datetime(changed_at, 'unixepoch'), sha256, url FROM books "
+               "WHERE changed_at >= ? ORDER BY changed_at DESC LIMIT ?",
+    'book': "SELECT *, (SELECT group_concat(tag, ', ') FROM book_tags WHERE book_tags.url = books.url) AS tags "
+            "FROM books WHERE url = ? OR name = ?",
+    'tags': "SELECT tag, count(*) FROM book_tags GROUP BY tag ORDER BY count(*) DESC LIMIT ?",
+    'shared': "SELECT books.name, group_concat(tag, ', '), book_tags.url FROM book_tags "
+              "LEFT JOIN books ON books.url = book_tags.url GROUP BY book_tags.url HAVING count(*) > 1 LIMIT ?",
+    'stats': "SELECT count(*), count(sha256), sum(size), round(avg(fetch_seconds), 3), "
+             "datetime(max(fetched_at), 'unixepoch') FROM books",
+}
+
+
+def timestamp(value):
+    """'2024-01-31' or '2024-01-31T12:00' -> unix time"""
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('catalog', help=f'path to {CATALOG_FILE_NAME}')
+    parser.add_argument('command', choices=(*QUERIES, 'sql'))
+    parser.add_argument('argument', nargs='?', help='book url or name for book, query for sql')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--since', type=timestamp, default=0, help='for changed, ISO date or date and time')
+    args = parser.parse_args()
+
+    if args.command in ('book', 'sql') and not args.argument:
+        parser.error(f"{args.command} needs an argument")
+    params = {
+        'book': (args.argument, args.argument),
+        'changed': (args.since, args.limit),
+        'sql': (),
+        'stats': (),
+    }.get(args.command, (args.limit,))
+    if not os.path.exists(args.catalog):
+        sys.exit(f"No catalog {args.catalog}")
+    connection = sqlite3.connect(f"file:{args.catalog}?mode=ro", uri=True)
+    cursor = connection.execute(args.argument if args.command == 'sql' else QUERIES[args.command], params)
+    columns = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    if args.command == 'book':
+        for row in rows:
+            for column, value in zip(columns, row):
+                print(f"{column:>14}: {value}")
+    else:
+        print('\t'.join(columns))
+        for row in rows:
+            print('\t'.join('' if value is None else str(value) for value in row))
+    if not rows and args.command == 'book':
+        sys.exit(f"No book {args.argument} in {args.catalog}")
+
+
+if __name__ == "__main__":
+    main()
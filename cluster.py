@@ -0,0 +1,186 @@
+"""
+Sharded dump: one coordinator, any number of workers on one or several hosts
+
+The coordinator lists the pages of the tags and puts every book into a `workqueue`, then waits for the workers
+and verifies the dump. Workers claim books in batches of `DUMP_WORKER_BATCH`, run the pipeline from the `books`
+stage into the shared dump directory and keep their leases with heartbeats. A book of a worker that died
+goes to another worker once its lease expires. Files, manifest and catalog of all workers make one dump.
+
+    python cluster.py coordinator GURPS.queue
+    python cluster.py worker GURPS.queue --processes 4   # on every host, any time
+
+Hosts must share the dump directory and the queue file at the same path, see `workqueue` for the filesystem.
+Workers write `metrics.<worker>.json` with their own numbers, to be summed, `DUMP_TRACE` gets the listing, and a trace per worker.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import datetime
+import threading
+
+import outputs
+import metrics
+import tracer
+import pipeline
+from logger import get_logger
+from workqueue import WorkQueue
+from pipeline import THREADS, DUMP_NAME, FORK, parse_placements
+from settings import SITE_BASE_URL, TIMESTAMP, RESUME, TRACE, PIPELINE, QUEUE_LEASE, QUEUE_POLL, WORKER_BATCH
+
+logger = get_logger(__name__)
+
+DUMP_DIR = 'dump_dir'
+SEALED = 'sealed'  # every book of the tags is in the queue
+REPORT_INTERVAL = 10  # seconds between progress lines of the coordinator
+
+WORKER_PRESET = {
+    'fetch_about': THREADS,
+    'write_about': THREADS,
+    'text': THREADS,
+}
+
+
+def coordinate(queue_path, dir_name):
+    """Lists the books into the queue, waits until no task is pending or leased, True if the merged dump is complete"""
+    if not pipeline.checks(SITE_BASE_URL, dir_name):
+        return False
+    os.makedirs(dir_name, exist_ok=RESUME)
+    outputs.recover(dir_name)
+    tracer.start()
+    pipeline.setup(dir_name)
+
+    queue = WorkQueue(queue_path)
+    queue.set(SEALED, False)
+    queue.set(DUMP_DIR, os.path.abspath(dir_name))  # workers start from here
+    books = {}  # a book listed under several tags is one task
+    try:
+        for page_url in pipeline.page_urls():
+            try:
+                for page in pipeline.fetch_page(page_url):
+                    for book_url, name, tags in pipeline.parse_page(page):
+                        books.setdefault(book_url, dict(url=book_url, name=name, tags=[]))['tags'].extend(tags)
+            except Exception:
+                logger.exception(f"Listing page {page_url} failed")
+                pipeline.manifest.page_failed(page_url)
+        added = queue.put((book_url, book) for book_url, book in books.items())
+    finally:
+        queue.set(SEALED, True)  # workers stop once the queue is sealed and empty, also when listing failed
+    logger.info(f"{added} books queued in {queue_path}")
+
+    reported = time.monotonic()
+    while queue.unfinished():
+        if time.monotonic() - reported > REPORT_INTERVAL:
+            logger.info(', '.join(f"{count} {state}" for state, count in queue.counts().items()))
+            reported = time.monotonic()
+        time.sleep(QUEUE_POLL)
+    failed = queue.failed()
+    for key, attempts, error in failed:
+        logger.error(f"{key} failed after {attempts} attempts: {error}")
+    queue.close()
+    tracer.write()  # the listing, workers write their own traces
+    return pipeline.manifest.complete() and not failed
+
+
+class Heartbeat(threading.Thread):
+    """Extends the leases of a batch every third of the lease time, on a connection of its own"""
+
+    def __init__(self, queue_path, owner, ids):
+        super().__init__(name='heartbeat', daemon=True)
+        self.queue_path = queue_path
+        self.owner = owner
+        self.ids = ids
+        self.stopped = threading.Event()
+
+    def run(self):
+        queue = WorkQueue(self.queue_path)
+        try:
+            while not self.stopped.wait(QUEUE_LEASE / 3):
+                held = queue.heartbeat(self.owner, self.ids)
+                if held < len(self.ids):
+                    logger.warning(f"{self.owner} lost {len(self.ids) - held} leases, the books may be dumped twice")
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def work(queue_path, placements, owner):
+    """Claims batches of books until the queue is sealed and nothing is left to claim or to wait for"""
+    queue = WorkQueue(queue_path)
+    while (dir_name := queue.get(DUMP_DIR)) is None or not os.path.isdir(dir_name):
+        time.sleep(QUEUE_POLL)
+    metrics.reset()  # forked from one process, the workers of a host would all count into the same values
+    tracer.start(f"{TRACE}.{owner}" if TRACE else '')  # parts of other workers are not ours to merge
+    # workers add to a dump the coordinator created, a reassigned book may have a directory already
+    pipeline.setup(dir_name, resume=True)
+    done = failed = 0
+    while True:
+        tasks = queue.claim(owner, WORKER_BATCH)
+        if not tasks:
+            if queue.get(SEALED) and not queue.unfinished():
+                break
+            time.sleep(QUEUE_POLL)
+            continue
+        books = [(task['payload']['url'], task['payload']['name'], tuple(task['payload']['tags'])) for task in tasks]
+        with Heartbeat(queue_path, owner, [task['id'] for task in tasks]):
+            pipeline.manifest.load()  # books other workers dumped meanwhile are skipped
+            pipeline.dump(dir_name, placements, books, entry='books')
+            pipeline.manifest.load()  # marks of the pool processes
+        for task, (book_url, name, _) in zip(tasks, books):
+            if pipeline.manifest.verify(book_url, os.path.join(dir_name, name)):
+                done += queue.finish(owner, task['id'])
+            else:
+                failed += 1
+                queue.finish(owner, task['id'], 'not verified')
+    queue.close()
+    logger.info(f"Worker {owner}: {done} books done, {failed} failed attempts")
+    metrics.write(dir_name, f"metrics.{owner}.json", textfile=None)
+    tracer.write()
+
+
+def worker(queue_path, placements):
+    work(queue_path, placements, f"{socket.gethostname()}-{os.getpid()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('role', choices=('coordinator', 'worker'))
+    parser.add_argument('queue', help='queue file shared by the coordinator and the workers')
+    parser.add_argument('--dump', default=f"{DUMP_NAME}_{TIMESTAMP}_cluster", help='dump directory, for the coordinator')
+    parser.add_argument('--processes', type=int, default=1, help='workers to start on this host')
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    logger.info('Start')
+    ok = True
+    if args.role == 'coordinator':
+        ok = coordinate(args.queue, args.dump)
+    else:
+        placements = dict(WORKER_PRESET, **parse_placements(PIPELINE))
+        processes = [
+            FORK.Process(target=worker, args=(args.queue, placements), name=f"Worker-{number}")
+            for number in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [f"{process.name} ({process.exitcode})" for process in processes if process.exitcode]
+        if failed:
+            logger.error(f"Workers failed: {', '.join(failed)}")
+            ok = False
+    logger.info(f"Done in {datetime.datetime.now() - start}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
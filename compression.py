@@ -0,0 +1,259 @@
+"""
+Streaming compression of result.txt
+
+`DUMP_COMPRESSION=gzip|zstd|xz` compresses book texts while they stream to disk. The body is cut into blocks
+of `BLOCK_SIZE` and every block is compressed on its own (a gzip member, a zstd frame, an xz stream)
+by a pool of `DUMP_COMPRESSION_WORKERS` threads, the codecs release the GIL, so compression runs in parallel
+with the download and with other books. Concatenated blocks are a valid file for the usual tools: `zcat`, `zstdcat`, `xzcat`.
+
+Readers do not need to know: `decompress` and `Decompressor` recognize the format by its magic bytes
+and pass anything else through.
+
+* `zstandard` - used for zstd when installed
+"""
+import os
+import gzip
+import lzma
+import zlib
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from logger import get_logger
+from settings import COMPRESSION, COMPRESSION_LEVEL, COMPRESSION_WORKERS
+
+logger = get_logger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+MAX_AHEAD = 4  # blocks of one file being compressed, the download waits for the oldest beyond that
+
+compressed_files = metrics.Counter('dump_compressed_files_total', 'Files compressed')
+compressed_bytes = metrics.Counter(
+    'dump_compression_bytes_total', 'Bytes into and out of the compressor', 'side', ('raw', 'compressed')
+)
+busy_seconds = metrics.Counter('dump_compression_busy_seconds_total', 'Time the compressor threads spent compressing')
+
+
+class Gzip:
+    name = 'gzip'
+    suffix = '.gz'
+    magic = b'\x1f\x8b'
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self.level = level or 6
+
+    def compress(self, block):
+        return gzip.compress(block, self.level, mtime=0)
+
+    def decompressor(self):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+class Xz:
+    name = 'xz'
+    suffix = '.xz'
+    magic = b'\xfd7zXZ\x00'
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self.level = level or 6
+
+    def compress(self, block):
+        return lzma.compress(block, preset=self.level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class Zstd:
+    name = 'zstd'
+    suffix = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level or 3
+
+    def compress(self, block):
+        # one compressor per call, they are not thread safe
+        return self.zstandard.ZstdCompressor(level=self.level, write_content_size=True).compress(block)
+
+    def decompressor(self):
+        return self.zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {
+    'gzip': Gzip,
+    'zstd': Zstd,
+    'xz': Xz,
+}
+SUFFIXES = tuple(codec.suffix for codec in CODECS.values())
+
+
+def make_codec(name=COMPRESSION):
+    """Codec of `DUMP_COMPRESSION`, None if compression is off"""
+    if not name:
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression {name}, expected {', '.join(CODECS)}")
+    return CODECS[name]()
+
+
+def detect(head):
+    """Codec that wrote data starting with `head`, None for plain data"""
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            try:
+                return codec()
+            except ImportError:
+                raise ValueError(f"Data is {codec.name} compressed, install {codec.name} support to read it")
+    return None
+
+
+class Decompressor:
+    """Incremental reader of a compressed or plain stream, blocks are decompressed one after another"""
+
+    def __init__(self):
+        self.codec = None
+        self.current = None
+        self.head = b''
+
+    def decompress(self, data):
+        if self.current is None and self.codec is None:
+            self.head += data
+            if len(self.head) < 6 and data:
+                return b''
+            data, self.head = self.head, b''
+            self.codec = detect(data) or False
+        if not self.codec:
+            return data
+        output = []
+        while data:
+            if self.current is None:
+                self.current = self.codec.decompressor()
+            output.append(self.current.decompress(data))
+            if not self.current.eof:
+                break
+            data, self.current = self.current.unused_data, None
+        return b''.join(output)
+
+    def flush(self):
+        """Rest of a stream shorter than the longest magic"""
+        if self.codec is None:
+            return self.decompress(b'')
+        return b''
+
+
+def decompress(data):
+    decompressor = Decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+_pool = None
+
+
+def _reset_pool():
+    global _pool
+    _pool = None
+
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+
+def pool():
+    """Compressor threads of this process"""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(COMPRESSION_WORKERS, thread_name_prefix='compress')
+    return _pool
+
+
+def compress_block(codec, block):
+    start = time.perf_counter()
+    compressed = codec.compress(block)
+    busy_seconds.inc(time.perf_counter() - start)
+    return compressed
+
+
+class CompressedWriter:
+    """
+    Compresses a stream written chunk by chunk into a binary file, writes it as is without a codec
+
+    Blocks leave for the pool as soon as they are full and are written in order as they come back.
+    `write` only waits when `MAX_AHEAD` blocks of this file are still being compressed, `async_write` awaits instead.
+    """
+
+    def __init__(self, file, codec):
+        self.file = file
+        self.codec = codec
+        self.buffer = bytearray()
+        self.futures = deque()
+        self.size = 0
+        self.compressed = 0
+
+    def submit(self):
+        self.futures.append(pool().submit(compress_block, self.codec, bytes(self.buffer)))
+        self.buffer.clear()
+
+    def feed(self, chunk):
+        if self.codec is None:
+            self.write_block(chunk)
+            self.size += len(chunk)
+            return
+        self.buffer += chunk
+        self.size += len(chunk)
+        if len(self.buffer) >= BLOCK_SIZE:
+            self.submit()
+
+    def write_done(self, wait=False):
+        while self.futures and (wait or self.futures[0].done() or len(self.futures) > MAX_AHEAD):
+            self.write_block(self.futures.popleft().result())
+
+    def write_block(self, block):
+        self.file.write(block)
+        self.compressed += len(block)
+
+    def write(self, chunk):
+        self.feed(chunk)
+        self.write_done()
+
+    async def async_write(self, chunk):
+        self.feed(chunk)
+        while len(self.futures) > MAX_AHEAD:
+            self.write_block(await asyncio.wrap_future(self.futures.popleft()))
+        self.write_done()
+
+    def finish(self):
+        if self.codec is not None and (self.buffer or not self.size):
+            self.submit()  # an empty body is still a valid compressed file
+
+    def close(self):
+        self.finish()
+        self.write_done(wait=True)
+        self.account()
+
+    async def async_close(self):
+        self.finish()
+        while self.futures:
+            self.write_block(await asyncio.wrap_future(self.futures.popleft()))
+        self.account()
+
+    def account(self):
+        if self.codec is None:
+            return
+        compressed_files.inc()
+        compressed_bytes.inc(self.size, 'raw')
+        compressed_bytes.inc(self.compressed, 'compressed')
+
+
+def report():
+    if COMPRESSION and compressed_files.value():
+        raw, compressed = compressed_bytes.value('raw'), compressed_bytes.value('compressed')
+        busy = busy_seconds.value()
+        logger.info(
+            f"Compression {COMPRESSION}: {compressed_files.value()} files, {raw} -> {compressed} bytes, "
+            f"ratio {raw / max(compressed, 1):.2f}, {raw / max(busy, 1e-9) / 2 ** 20:.1f} MB/s per worker thread, "
+            f"{busy:.2f} s compressing"
+        )
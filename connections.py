@@ -0,0 +1,85 @@
+"""
+Pooled keep-alive `requests` sessions and a DNS cache
+
+Every thread gets its own `requests.Session`, so a worker reuses its connections instead of paying a
+TCP (and TLS) handshake per request. Forked worker processes start with fresh sessions,
+sockets of the parent are never shared. `DUMP_KEEP_ALIVE=0` goes back to a new connection per request,
+the baseline for the benchmark.
+"""
+import os
+import time
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from logger import get_logger
+from settings import KEEP_ALIVE, POOL_CONNECTIONS, POOL_MAXSIZE, DNS_CACHE_TTL
+
+logger = get_logger(__name__)
+
+sessions = metrics.Counter('dump_sessions_total', 'HTTP sessions created')
+resolutions = metrics.Counter(
+    'dump_dns_resolutions_total', 'Name resolutions by getaddrinfo or the DNS cache', 'source', ('lookup', 'cache')
+)
+
+
+_local = threading.local()
+
+
+def _reset_local():
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_local)
+
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    sessions.inc()
+    return session
+
+
+def session():
+    """Session of the calling thread, plain `requests` module without keep-alive"""
+    if not KEEP_ALIVE:
+        return requests
+    if getattr(_local, 'session', None) is None:
+        _local.session = make_session()
+    return _local.session
+
+
+_getaddrinfo = socket.getaddrinfo
+_dns_cache = {}
+
+
+def cached_getaddrinfo(*args, **kwargs):
+    """`socket.getaddrinfo` with answers kept for `DNS_CACHE_TTL` seconds"""
+    key = (args, tuple(sorted(kwargs.items())))
+    cached = _dns_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        resolutions.inc(label='cache')
+        return cached[1]
+    addresses = _getaddrinfo(*args, **kwargs)
+    _dns_cache[key] = (time.monotonic() + DNS_CACHE_TTL, addresses)
+    resolutions.inc(label='lookup')
+    return addresses
+
+
+def install_dns_cache():
+    """Routes name resolution through the cache, aiohttp connectors also cache for `DNS_CACHE_TTL`"""
+    if DNS_CACHE_TTL and socket.getaddrinfo is not cached_getaddrinfo:
+        socket.getaddrinfo = cached_getaddrinfo
+
+
+def report():
+    logger.info(
+        f"Connections: {sessions.value()} sessions, keep-alive {'on' if KEEP_ALIVE else 'off'}, "
+        f"DNS {resolutions.value('lookup')} lookups, {resolutions.value('cache')} cached"
+    )
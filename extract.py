@@ -0,0 +1,401 @@
+"""
+HTML extraction used by all variants
+
+The dump needs three things from the site: `dt > a` links of `dl.translations-list`, `spager` links
+and the text of `#about-translation blockquote`. Building a full BeautifulSoup tree for that is the main
+CPU cost of the process pool variants, so extraction goes through a backend picked by `DUMP_HTML_BACKEND`:
+
+* `selectolax` and `lxml` - C parsers, used when installed
+* `stdlib` - targeted `html.parser` that starts at the wanted element and stops at its end tag
+* `bs4` - BeautifulSoup with `html.parser`, the reference, and the fallback whenever a backend fails
+
+    python extract.py check
+    python extract.py bench --repeat 2000 --padding 64
+"""
+import re
+import sys
+import json
+import time
+import argparse
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+from logger import get_logger
+from settings import HTML_BACKEND
+
+logger = get_logger(__name__)
+
+
+class ExtractError(ValueError):
+    """Page does not have the expected element"""
+
+
+class Bs4Extractor:
+    name = 'bs4'
+
+    def book_links(self, html):
+        dl = BeautifulSoup(html, 'html.parser').find('dl', {'class': 'translations-list'})
+        if dl is None:
+            raise ExtractError('no translations-list')
+        return [(dt.a.get_text(), dt.a.get('href')) for dt in dl.find_all('dt') if dt.a is not None]
+
+    def pager_links(self, html):
+        div = BeautifulSoup(html, 'html.parser').find('div', {'class': 'spager'})
+        if div is None:
+            raise ExtractError('no spager')
+        return [(a.get_text(), a['href']) for a in div.find_all('a', href=True)]
+
+    def about_text(self, html):
+        div = BeautifulSoup(html, 'html.parser').find(id='about-translation')
+        if div is None:
+            raise ExtractError('no about-translation')
+        return div.blockquote.get_text().strip() if div.blockquote else ''
+
+
+class _Done(Exception):
+    pass
+
+
+class _ElementParser(HTMLParser):
+    """Fed from the start tag of one element on, stops at its end tag"""
+
+    def __init__(self, tag):
+        super().__init__(convert_charrefs=True)
+        self.tag = tag
+        self.depth = 0
+        self.text = None  # list of text parts while inside an element of interest
+        self.result = []
+
+    def parse(self, html):
+        try:
+            self.feed(html)
+            self.close()
+        except _Done:
+            pass
+        return self.result
+
+    def handle_starttag(self, tag, attrs):
+        if tag == self.tag:
+            self.depth += 1
+        self.start(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.end(tag)
+        if tag == self.tag:
+            self.depth -= 1
+            if self.depth == 0:
+                raise _Done
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def start(self, tag, attrs):
+        pass
+
+    def end(self, tag):
+        pass
+
+
+class _BookLinksParser(_ElementParser):
+
+    def __init__(self):
+        super().__init__('dl')
+        self.in_dt = False
+        self.href = None
+
+    def start(self, tag, attrs):
+        if tag == 'dt':
+            self.in_dt = True
+        elif tag == 'a' and self.in_dt and self.text is None:
+            self.href, self.text = dict(attrs).get('href'), []
+
+    def end(self, tag):
+        if tag == 'a' and self.text is not None:
+            self.result.append((''.join(self.text), self.href))
+            self.text = None
+            self.in_dt = False  # only the first link of a dt
+        elif tag == 'dt':
+            self.in_dt = False
+
+
+class _PagerLinksParser(_ElementParser):
+
+    def __init__(self):
+        super().__init__('div')
+        self.href = None
+
+    def start(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and 'href' in attrs:
+            self.href, self.text = attrs['href'] or '', []
+
+    def end(self, tag):
+        if tag == 'a' and self.text is not None:
+            self.result.append((''.join(self.text), self.href))
+            self.text = None
+
+
+class _AboutParser(_ElementParser):
+
+    def __init__(self, tag):
+        super().__init__(tag)
+        self.quote_depth = 0
+
+    def start(self, tag, attrs):
+        if tag == 'blockquote':
+            self.quote_depth += 1
+            if self.text is None:
+                self.text = []
+
+    def end(self, tag):
+        if tag == 'blockquote' and self.quote_depth:
+            self.quote_depth -= 1
+            if not self.quote_depth:
+                self.result = self.text
+                raise _Done
+
+
+class StdlibExtractor:
+    """Finds the start tag with a regular expression and parses from there, the rest of the page is never parsed"""
+    name = 'stdlib'
+
+    BOOK_LIST = re.compile(r'<dl\s[^>]*?class\s*=\s*["\']?[^"\'>]*(?<![\w-])translations-list(?![\w-])', re.I)
+    PAGER = re.compile(r'<div\s[^>]*?class\s*=\s*["\']?[^"\'>]*(?<![\w-])spager(?![\w-])', re.I)
+    ABOUT = re.compile(r'<(\w+)\s[^>]*?id\s*=\s*["\']?about-translation(?![\w-])', re.I)
+
+    def find(self, pattern, html, what):
+        match = pattern.search(html)
+        if match is None:
+            raise ExtractError(f'no {what}')
+        return match
+
+    def book_links(self, html):
+        match = self.find(self.BOOK_LIST, html, 'translations-list')
+        return _BookLinksParser().parse(html[match.start():])
+
+    def pager_links(self, html):
+        match = self.find(self.PAGER, html, 'spager')
+        return _PagerLinksParser().parse(html[match.start():])
+
+    def about_text(self, html):
+        match = self.find(self.ABOUT, html, 'about-translation')
+        return ''.join(_AboutParser(match.group(1).lower()).parse(html[match.start():])).strip()
+
+
+class LxmlExtractor:
+    name = 'lxml'
+
+    BOOK_LIST = '//dl[contains(concat(" ", normalize-space(@class), " "), " translations-list ")]'
+    PAGER = '//div[contains(concat(" ", normalize-space(@class), " "), " spager ")]'
+
+    def __init__(self):
+        import lxml.html
+        self.parse = lxml.html.fromstring
+
+    def first(self, html, path, what):
+        found = self.parse(html).xpath(path)
+        if not found:
+            raise ExtractError(f'no {what}')
+        return found[0]
+
+    def book_links(self, html):
+        links = (dt.find('.//a') for dt in self.first(html, self.BOOK_LIST, 'translations-list').iter('dt'))
+        return [(a.text_content(), a.get('href')) for a in links if a is not None]
+
+    def pager_links(self, html):
+        return [(a.text_content(), a.get('href')) for a in self.first(html, self.PAGER, 'spager').xpath('.//a[@href]')]
+
+    def about_text(self, html):
+        blockquote = self.first(html, '//*[@id="about-translation"]', 'about-translation').find('.//blockquote')
+        return blockquote.text_content().strip() if blockquote is not None else ''
+
+
+class SelectolaxExtractor:
+    name = 'selectolax'
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self.parse = LexborHTMLParser
+
+    def first(self, html, selector, what):
+        node = self.parse(html).css_first(selector)
+        if node is None:
+            raise ExtractError(f'no {what}')
+        return node
+
+    def book_links(self, html):
+        links = (dt.css_first('a') for dt in self.first(html, 'dl.translations-list', 'translations-list').css('dt'))
+        return [(a.text(), a.attributes.get('href')) for a in links if a is not None]
+
+    def pager_links(self, html):
+        return [(a.text(), a.attributes['href'] or '') for a in self.first(html, 'div.spager', 'spager').css('a[href]')]
+
+    def about_text(self, html):
+        blockquote = self.first(html, '#about-translation', 'about-translation').css_first('blockquote')
+        return blockquote.text().strip() if blockquote is not None else ''
+
+
+BACKENDS = {
+    'selectolax': SelectolaxExtractor,
+    'lxml': LxmlExtractor,
+    'stdlib': StdlibExtractor,
+    'bs4': Bs4Extractor,
+}
+AUTO_ORDER = ('selectolax', 'lxml', 'stdlib')
+
+
+def available_backends():
+    backends = {}
+    for name, backend in BACKENDS.items():
+        try:
+            backends[name] = backend()
+        except ImportError:
+            continue
+    return backends
+
+
+def make_extractor(name=HTML_BACKEND):
+    if name != 'auto':
+        return BACKENDS[name]()
+    for name in AUTO_ORDER:
+        try:
+            return BACKENDS[name]()
+        except ImportError:
+            continue
+
+
+reference = Bs4Extractor()
+extractor = make_extractor()
+
+
+def with_fallback(method):
+    def extract(html):
+        try:
+            return getattr(extractor, method)(html)
+        except Exception as e:
+            if extractor is reference:
+                raise
+            logger.warning(f"{extractor.name} failed to extract {method} ({e!r}), falling back to bs4")
+            return getattr(reference, method)(html)
+    extract.__name__ = method
+    return extract
+
+
+book_links = with_fallback('book_links')  # [(book name, href)] of a listing page
+pager_links = with_fallback('pager_links')  # [(link text, href)] of the pager
+about_text = with_fallback('about_text')  # stripped text of the about blockquote, '' if there is none
+
+
+def fixtures():
+    """Golden pages with the expected extraction, mock site pages and a few nastier hand-written ones"""
+    import mock_server
+
+    site = mock_server.MockSite(books=45, per_page=20)
+    yield 'mock listing', site.listing('GURPS', 1), {
+        'book_links': [(site.book_name(i), f"/you/{site.book_slug(i)}/trans/") for i in range(20)],
+        'pager_links': [('2', '/you/tags/GURPS/?page=2'), ('3', '/you/tags/GURPS/?page=3')],
+    }
+    yield 'mock last page', site.listing('GURPS', 3), {
+        'book_links': [(site.book_name(i), f"/you/{site.book_slug(i)}/trans/") for i in range(40, 45)],
+        'pager_links': [('1', '/you/tags/GURPS/'), ('2', '/you/tags/GURPS/?page=2')],
+    }
+    yield 'mock about', site.about(7), {'about_text': 'About translation of book 7'}
+    yield 'messy listing', (
+        '<html><body><div class="spager-wrap"><a href="/nope/">0</a></div>'
+        '<dl class="other-list"><dt><a href="/wrong/">Wrong</a></dt></dl>'
+        '<DL CLASS="big translations-list"><dt><A HREF="/you/a/trans/">Tom &amp; Jerry\nvol. 1</A>'
+        ' <a href="/you/author/">author</a></dt><dd><a href="/x/">x</a></dd>'
+        '<dt>no link</dt><dt><a href=\'/you/b/trans/\'><b>Bold</b> name</a></dt></DL>'
+        '<div class="spager"><div class="inner"><a href="/p/2">2</a></div><a>no href</a>'
+        '<a href="/p/3">&#51;</a></div><div class="spager"><a href="/later/">9</a></div></body></html>'
+    ), {
+        'book_links': [('Tom & Jerry\nvol. 1', '/you/a/trans/'), ('Bold name', '/you/b/trans/')],
+        'pager_links': [('2', '/p/2'), ('3', '/p/3')],
+    }
+    yield 'about without blockquote', '<div id="about-translation"><h2>About</h2><p>none</p></div>', {
+        'about_text': '',
+    }
+    yield 'about with markup', (
+        '<section id="about-translation"><blockquote>\n  Первая <i>часть</i> &laquo;книги&raquo;\n'
+        '</blockquote><blockquote>second</blockquote></section>'
+    ), {'about_text': 'Первая часть «книги»'}
+
+
+def check(backends):
+    """Compares every backend with the golden fixtures, returns number of mismatches"""
+    failures = 0
+    for name, html, expected in fixtures():
+        for method, value in expected.items():
+            for backend in backends.values():
+                got = getattr(backend, method)(html)
+                if got != value:
+                    failures += 1
+                    logger.error(f"{backend.name} {method} on {name}: expected {value!r}, got {got!r}")
+    return failures
+
+
+def bench(backends, repeat, padding):
+    """Extraction throughput per backend on mock pages with `padding` KiB of unrelated markup around the content"""
+    import mock_server
+
+    site = mock_server.MockSite(books=60, per_page=20)
+    filler = ''.join(f'<div class="nav"><a href="/menu/{i}/">item {i}</a> <span>text</span></div>\n' for i in range(20))
+    filler = filler * (padding * 1024 // len(filler) + 1) if padding else ''
+    head, tail = filler[:len(filler) // 2], filler[len(filler) // 2:]
+    pages = {
+        'book_links': site.listing('GURPS', 2).replace('<body>', '<body>' + head).replace('</body>', tail + '</body>'),
+        'pager_links': site.listing('GURPS', 2).replace('<body>', '<body>' + head).replace('</body>', tail + '</body>'),
+        'about_text': site.about(1).replace('<body>', '<body>' + head).replace('</body>', tail + '</body>'),
+    }
+    results = []
+    for backend in backends.values():
+        for method, html in pages.items():
+            extract = getattr(backend, method)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                extract(html)
+            elapsed = time.perf_counter() - start
+            results.append({
+                'backend': backend.name,
+                'method': method,
+                'page_bytes': len(html.encode('utf-8')),
+                'pages_per_second': round(repeat / elapsed, 1),
+                'mb_per_second': round(repeat * len(html.encode('utf-8')) / elapsed / 2 ** 20, 2),
+            })
+            logger.info(f"{backend.name} {method}: {results[-1]['pages_per_second']} pages/s, "
+                        f"{results[-1]['mb_per_second']} MB/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('check', 'bench'))
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, help='installed ones by default')
+    parser.add_argument('--repeat', type=int, default=500, help='extractions per page and backend')
+    parser.add_argument('--padding', type=int, default=0, help='KiB of unrelated markup added to pages')
+    parser.add_argument('--output', help='write bench results as json to this file instead of stdout')
+    args = parser.parse_args()
+
+    backends = available_backends()
+    if args.backends:
+        backends = {name: backends.get(name) or BACKENDS[name]() for name in args.backends}
+    logger.info(f"Backends: {', '.join(backends)}, default {extractor.name}")
+
+    if args.command == 'check':
+        failures = check(backends)
+        logger.info(f"{failures} mismatches" if failures else 'All backends match the golden fixtures')
+        sys.exit(1 if failures else 0)
+
+    results = bench(backends, args.repeat, args.padding)
+    if args.output:
+        with open(args.output, 'wt', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Version history of book texts as a base plus line deltas
+
+`DUMP_HISTORY_DIR=history` makes every run add the `result.txt` of new and changed books to a history shared by all dumps.
+Each book has a directory with `versions.jsonl` and one file per version: a full text (base) or the lines that differ
+from the previous version (delta), both zlib compressed. After `DUMP_HISTORY_REBASE` deltas, or when a delta would not
+be much smaller than the text, a new base is stored, so reading any version applies only a few deltas.
+
+    python history.py log history https://translatedby.com/you/some-book/
+    python history.py show history https://translatedby.com/you/some-book/ --version 3 > old.txt
+    python history.py usage history
+
+The coordinator is the only writer, two dumps must not add to one history at the same time.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import hashlib
+import difflib
+import argparse
+
+from logger import get_logger
+from manifest import TEXT_FILE_NAME
+from settings import HISTORY_REBASE
+
+logger = get_logger(__name__)
+
+VERSIONS_FILE_NAME = 'versions.jsonl'
+BASE = 'base'
+DELTA = 'delta'
+DELTA_MAX_RATIO = 0.5  # a delta larger than this part of the text is stored as a base
+
+COPY = b'C'  # lines [start, start + count) of the previous version
+INSERT = b'I'  # count new lines follow, each prefixed by its length
+NUMBERS = struct.Struct('<II')
+LENGTH = struct.Struct('<I')
+
+
+def make_delta(old_lines, new_lines):
+    parts = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            parts.append(COPY + NUMBERS.pack(i1, i2 - i1))
+        elif j2 > j1:
+            parts.append(INSERT + LENGTH.pack(j2 - j1))
+            parts.extend(LENGTH.pack(len(line)) + line for line in new_lines[j1:j2])
+    return b''.join(parts)
+
+
+def apply_delta(old_lines, delta):
+    lines, position = [], 0
+    while position < len(delta):
+        op, position = delta[position:position + 1], position + 1
+        if op == COPY:
+            start, count = NUMBERS.unpack_from(delta, position)
+            position += NUMBERS.size
+            lines.extend(old_lines[start:start + count])
+        elif op == INSERT:
+            (count,), position = LENGTH.unpack_from(delta, position), position + LENGTH.size
+            for _ in range(count):
+                (length,), position = LENGTH.unpack_from(delta, position), position + LENGTH.size
+                lines.append(delta[position:position + length])
+                position += length
+        else:
+            raise ValueError(f"Corrupt delta, unknown op {op!r} at {position - 1}")
+    return lines
+
+
+def book_dir(root, book_url):
+    key = hashlib.sha256(book_url.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(root, key[:2], key)
+
+
+def versions(root, book_url):
+    """Version records of a book, oldest first"""
+    path = os.path.join(book_dir(root, book_url), VERSIONS_FILE_NAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+def load(root, book_url, version):
+    with open(os.path.join(book_dir(root, book_url), version['file']), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+def reconstruct_lines(root, book_url, records, number):
+    """Lines of version `number`, from its base through the deltas after it"""
+    chain = []
+    for version in reversed(records[:number]):
+        chain.append(version)
+        if version['kind'] == BASE:
+            break
+    lines = load(root, book_url, chain.pop()).splitlines(keepends=True)
+    for version in reversed(chain):
+        lines = apply_delta(lines, load(root, book_url, version))
+    return lines
+
+
+def reconstruct(root, book_url, number=None):
+    """Text of version `number` of a book, 1 is the first, the latest by default"""
+    records = versions(root, book_url)
+    if not records:
+        raise KeyError(f"No history of {book_url}")
+    number = number or len(records)
+    if not 1 <= number <= len(records):
+        raise KeyError(f"{book_url} has versions 1 to {len(records)}, not {number}")
+    body = b''.join(reconstruct_lines(root, book_url, records, number))
+    if hashlib.sha256(body).hexdigest() != records[number - 1]['sha256']:
+        raise ValueError(f"Version {number} of {book_url} does not match its sha256")
+    return body
+
+
+class History:
+    """
+    Single writer, fed with catalog records of result.txt like `search.SearchIndex`
+
+    `read(book_name, file_name)` returns a written file, records wait while it is not in the output yet.
+    """
+
+    def __init__(self, root, dump, read=None, rebase=HISTORY_REBASE):
+        self.root = root
+        self.dump = dump
+        self.read = read
+        self.rebase = rebase
+        self.pending = []
+        self.added = {BASE: 0, DELTA: 0}
+        self.sizes = [0, 0]  # texts and what was stored for them
+
+    def add(self, record):
+        self.pending.append(record)
+        self.flush()
+
+    def flush(self):
+        waiting = []
+        for record in self.pending:
+            records = versions(self.root, record['url'])
+            if records and records[-1]['sha256'] == record['sha256']:
+                continue
+            try:
+                body = self.read(record['name'], TEXT_FILE_NAME)
+            except OSError:
+                waiting.append(record)
+                continue
+            self.store(record, records, body)
+        self.pending = waiting
+
+    def store(self, record, records, body):
+        kind, data = BASE, body
+        since_base = next((i for i, version in enumerate(reversed(records)) if version['kind'] == BASE), None)
+        if records and since_base < self.rebase:
+            old_lines = reconstruct_lines(self.root, record['url'], records, len(records))
+            delta = make_delta(old_lines, body.splitlines(keepends=True))
+            if len(delta) < len(body) * DELTA_MAX_RATIO:
+                kind, data = DELTA, delta
+        number = len(records) + 1
+        directory = book_dir(self.root, record['url'])
+        os.makedirs(directory, exist_ok=True)
+        file_name = f"{number:04}.{kind}.z"
+        compressed = zlib.compress(data, 6)
+        with open(os.path.join(directory, file_name + '.tmp'), 'wb') as f:
+            f.write(compressed)
+        os.replace(os.path.join(directory, file_name + '.tmp'), os.path.join(directory, file_name))
+        version = dict(
+            version=number, kind=kind, file=file_name, url=record['url'], name=record['name'], dump=self.dump,
+            sha256=record['sha256'], size=len(body), stored=len(compressed), ts=round(time.time(), 3),
+        )
+        with open(os.path.join(directory, VERSIONS_FILE_NAME), 'at', encoding='utf-8') as f:
+            f.write(json.dumps(version, ensure_ascii=False) + '\n')
+        self.added[kind] += 1
+        self.sizes[0] += len(body)
+        self.sizes[1] += len(compressed)
+
+    def close(self):
+        self.flush()
+        for record in self.pending:
+            logger.warning(f"Not added to history {record['url']}, no result.txt in the output")
+        logger.info(
+            f"History: {self.added[BASE]} bases, {self.added[DELTA]} deltas, "
+            f"{self.sizes[0]} bytes of text stored in {self.sizes[1]}, {self.root}"
+        )
+
+
+def usage(root):
+    """Books, versions, bytes the versions would take in full and bytes stored"""
+    books, count, full, stored = 0, 0, 0, 0
+    for dir_path, _, file_names in os.walk(root):
+        if VERSIONS_FILE_NAME in file_names:
+            books += 1
+            with open(os.path.join(dir_path, VERSIONS_FILE_NAME), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    version = json.loads(line)
+                    count += 1
+                    full += version['size']
+                    stored += version['stored']
+    return books, count, full, stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('log', 'show', 'usage'))
+    parser.add_argument('history', help='history directory, DUMP_HISTORY_DIR of the dumps')
+    parser.add_argument('book', nargs='?', help='book url')
+    parser.add_argument('--version', type=int, help='for show, 1 is the first, the latest by default')
+    args = parser.parse_args()
+
+    if args.command == 'usage':
+        books, count, full, stored = usage(args.history)
+        print(f"{books} books, {count} versions, {full} bytes of text stored in {stored}")
+        return
+    if not args.book:
+        parser.error(f"{args.command} needs a book url")
+    try:
+        if args.command == 'log':
+            records = versions(args.history, args.book)
+            if not records:
+                raise KeyError(f"No history of {args.book}")
+            for version in records:
+                print(
+                    f"{version['version']:>4}  {version['kind']:<5}  {version['size']:>9} -> {version['stored']:>8}  "
+                    f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(version['ts']))}  {version['dump']}"
+                )
+        else:
+            sys.stdout.buffer.write(reconstruct(args.history, args.book, args.version))
+    except KeyError as e:
+        sys.exit(e.args[0])
+
+
+if __name__ == "__main__":
+    main()
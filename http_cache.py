@@ -0,0 +1,282 @@
+"""
+Persistent conditional-GET cache shared by all dump variants
+
+Bodies are kept on disk together with their ETag / Last-Modified validators,
+the next run sends If-None-Match / If-Modified-Since and reuses the cached body on 304.
+Enabled by `DUMP_HTTP_CACHE_DIR`, counters are shared with forked pool processes.
+"""
+import os
+import json
+import hashlib
+
+import requests
+from requests.utils import get_encoding_from_headers
+
+import metrics
+import connections
+from logger import get_logger
+from settings import HTTP_CACHE_DIR
+
+logger = get_logger(__name__)
+
+lookups = metrics.Counter(
+    'dump_http_cache_requests_total', 'Requests answered from the HTTP cache or not', 'result', ('hit', 'miss')
+)
+saved_bytes = metrics.Counter('dump_http_cache_saved_bytes_total', 'Body bytes answered from the HTTP cache')
+
+
+def cache_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    cache_dir = os.path.join(HTTP_CACHE_DIR, key[:2])
+    return os.path.join(cache_dir, f"{key}.json"), os.path.join(cache_dir, f"{key}.body")
+
+
+def load_meta(url):
+    if not HTTP_CACHE_DIR:
+        return None
+    meta_path, body_path = cache_paths(url)
+    try:
+        with open(meta_path, 'rt', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if os.path.exists(body_path) else None
+
+
+def request_headers(meta):
+    headers = {}
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def is_cacheable(headers):
+    return bool(HTTP_CACHE_DIR) and bool(headers.get('ETag') or headers.get('Last-Modified'))
+
+
+class CacheWriter:
+    """
+    Writes one cache entry chunk by chunk, nothing is visible before `commit`
+    the meta file is replaced last, so a torn write is just a miss
+    """
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_type': headers.get('Content-Type'),
+            'size': 0,
+        }
+        self.meta_path, self.body_path = cache_paths(url)
+        self.suffix = f".{os.getpid()}.{id(self)}.tmp"
+        self.file = None
+
+    def write(self, chunk):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.body_path), exist_ok=True)
+            self.file = open(self.body_path + self.suffix, 'wb')
+        self.file.write(chunk)
+        self.meta['size'] += len(chunk)
+
+    def commit(self):
+        if self.file is None:
+            self.write(b'')
+        self.file.close()
+        self.file = None
+        os.replace(self.body_path + self.suffix, self.body_path)
+        with open(self.meta_path + self.suffix, 'wt', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(self.meta_path + self.suffix, self.meta_path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.body_path + self.suffix)
+            self.file = None
+
+
+def store(url, headers, body):
+    if is_cacheable(headers):
+        writer = CacheWriter(url, headers)
+        writer.write(body)
+        writer.commit()
+
+
+class TeeReader:
+    """Wraps `response.raw` of a streamed response, everything read is copied into the cache"""
+
+    def __init__(self, raw, writer):
+        self.raw = raw
+        self.writer = writer
+        self.done = False
+
+    def read(self, amt=None, **kwargs):
+        try:
+            chunk = self.raw.read(amt, decode_content=True)
+        except BaseException:
+            self.writer.abort()
+            raise
+        if chunk:
+            self.writer.write(chunk)
+        elif not self.done:
+            self.writer.commit()
+            self.done = True
+        return chunk
+
+    def close(self):
+        self.writer.abort()
+        self.raw.close()
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+
+class CachedBody:
+    """`response.raw` of a cache hit, the file is closed once it is read to the end or by `Response.close()`"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+    def read(self, amt=None, **kwargs):
+        if self.file.closed:
+            return b''
+        chunk = self.file.read(amt)
+        if not chunk:
+            self.file.close()
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+    def release_conn(self):
+        pass
+
+
+def get(url, stream=False, **kwargs):
+    """GET on the thread's pooled session with conditional headers, 304 is turned into 200 with the cached body"""
+    meta = load_meta(url)
+    response = connections.session().get(url, headers=request_headers(meta), stream=stream, **kwargs)
+    if not HTTP_CACHE_DIR:
+        return response
+
+    if response.status_code == requests.codes.not_modified and meta:
+        response.raw.drain_conn()  # the empty 304 body, then the socket goes back to the pool instead of closing
+        response.raw.release_conn()
+        response.status_code = requests.codes.ok
+        if meta.get('content_type'):
+            response.headers['Content-Type'] = meta['content_type']
+            response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = CachedBody(cache_paths(url)[1])
+        response._content, response._content_consumed = False, False
+        if not stream:
+            response.content  # read cached body right away, as requests does
+        lookups.inc(label='hit')
+        saved_bytes.inc(meta['size'])
+        return response
+    lookups.inc(label='miss')
+    if response.status_code == requests.codes.ok and is_cacheable(response.headers):
+        if stream:
+            response.raw = TeeReader(response.raw, CacheWriter(url, response.headers))
+        else:
+            store(url, response.headers, response.content)
+    return response
+
+
+class CachedContent:
+    """Stand-in for `aiohttp.StreamReader` of a cached body"""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    async def iter_chunked(self, n):
+        with open(self.path, 'rb') as f:
+            while chunk := f.read(n):
+                yield chunk
+
+
+class CachedResponse:
+    """Minimal stand-in for `aiohttp.ClientResponse` built from a cache entry"""
+
+    status = 200
+
+    def __init__(self, url, meta):
+        self.url = url
+        self.headers = {'Content-Type': meta.get('content_type') or 'application/octet-stream'}
+        if meta.get('etag'):
+            self.headers['ETag'] = meta['etag']
+        if meta.get('last_modified'):
+            self.headers['Last-Modified'] = meta['last_modified']
+        self.content = CachedContent(cache_paths(url)[1])
+
+    async def read(self):
+        return await self.content.read()
+
+    def get_encoding(self):
+        return get_encoding_from_headers(self.headers) or 'utf-8'
+
+    async def text(self, encoding=None):
+        return (await self.read()).decode(encoding or self.get_encoding())
+
+    def release(self):
+        pass
+
+
+class TeeStream:
+    """Wraps `response.content` of a 200 response, the body is copied into the cache while it is consumed"""
+
+    def __init__(self, content, writer):
+        self.content = content
+        self.writer = writer
+
+    async def read(self):
+        body = await self.content.read()
+        self.writer.write(body)
+        self.writer.commit()
+        return body
+
+    async def iter_chunked(self, n):
+        try:
+            async for chunk in self.content.iter_chunked(n):
+                self.writer.write(chunk)
+                yield chunk
+        except BaseException:
+            self.writer.abort()
+            raise
+        self.writer.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.content, name)
+
+
+async def async_get(url, session, **kwargs):
+    """`session.get` with conditional headers, 304 is answered with `CachedResponse`"""
+    meta = load_meta(url)
+    response = await session.get(url, headers=request_headers(meta), **kwargs)
+    if not HTTP_CACHE_DIR:
+        return response
+
+    if response.status == 304 and meta:
+        response.release()
+        lookups.inc(label='hit')
+        saved_bytes.inc(meta['size'])
+        return CachedResponse(url, meta)
+    lookups.inc(label='miss')
+    if response.status == 200 and is_cacheable(response.headers):
+        response.content = TeeStream(response.content, CacheWriter(url, response.headers))
+    return response
+
+
+def report():
+    if HTTP_CACHE_DIR:
+        logger.info(
+            f"HTTP cache: {lookups.value('hit')} hits, {lookups.value('miss')} misses, "
+            f"{saved_bytes.value()} bytes saved"
+        )
@@ -0,0 +1,119 @@
+"""
+What crosses the process pool boundary
+
+Process workers get raw bodies and their encoding, never response objects or decoded text, and decode themselves.
+Bodies of `IPC_SPOOL_THRESHOLD` bytes or more go through a spool file the worker maps into memory and decodes in place,
+so only a short path is pickled. Tasks are pickled here rather than by the executor to measure bytes and time per stage.
+"""
+import os
+import mmap
+import time
+import pickle
+import tempfile
+from collections import Counter, defaultdict
+
+from logger import get_logger
+from settings import IPC_SPOOL_THRESHOLD
+
+logger = get_logger(__name__)
+
+SPOOL_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+stats = defaultdict(Counter)
+
+
+class Spooled:
+    """Body written to a spool file by the parent, removed by it once the task is done"""
+
+    def __init__(self, body):
+        fd, self.path = tempfile.mkstemp(prefix='dump-ipc-', dir=SPOOL_DIR)
+        with open(fd, 'wb') as f:
+            f.write(body)
+        self.size = len(body)
+
+    def decode(self, encoding):
+        if not self.size:
+            return ''
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+            return str(body, encoding, 'replace')
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def decode(body, encoding):
+    """Text of a body that is either bytes or `Spooled`"""
+    if isinstance(body, Spooled):
+        return body.decode(encoding or 'utf-8')
+    return str(body, encoding or 'utf-8', 'replace')
+
+
+def spool(item):
+    """Copy of a task item with large bodies replaced by `Spooled`"""
+    if isinstance(item, (tuple, list)):
+        return type(item)(spool(value) for value in item)
+    if isinstance(item, bytes) and IPC_SPOOL_THRESHOLD and len(item) >= IPC_SPOOL_THRESHOLD:
+        return Spooled(item)
+    return item
+
+
+def release(item):
+    """Removes spool files of an item returned by `spool`, returns their total size"""
+    if isinstance(item, (tuple, list)):
+        return sum(release(value) for value in item)
+    if isinstance(item, Spooled):
+        item.remove()
+        return item.size
+    return 0
+
+
+def call(data):
+    """Worker side of `submit`, returns pickled result, serialization and run time"""
+    start = time.perf_counter()
+    func, name, item = pickle.loads(data)
+    loaded = time.perf_counter()
+    value = func(name, item)
+    done = time.perf_counter()
+    result = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return result, loaded - start + time.perf_counter() - done, done - loaded
+
+
+async def submit(loop, executor, func, name, item, items=1):
+    """
+    Runs `func(name, item)` on a process pool, `item` may be a batch of `items`
+
+    Counts per stage pickled bytes, serialization time on both sides, time spent in `func`
+    and the rest of the round trip: pool queueing, scheduling and pipe transfer.
+    """
+    item = spool(item)
+    try:
+        start = time.perf_counter()
+        data = pickle.dumps((func, name, item), pickle.HIGHEST_PROTOCOL)
+        sent = time.perf_counter()
+        result, worker_serialization, busy = await loop.run_in_executor(executor, call, data)
+        received = time.perf_counter()
+    finally:
+        spooled = release(item)
+    value = pickle.loads(result)
+    counter = stats[name]
+    counter['tasks'] += 1
+    counter['items'] += items
+    counter['sent'] += len(data)
+    counter['received'] += len(result)
+    counter['spooled'] += spooled
+    counter['serialization'] += sent - start + time.perf_counter() - received + worker_serialization
+    counter['busy'] += busy
+    counter['wait'] += received - sent - worker_serialization - busy
+    return value
+
+
+def report():
+    for name, counter in stats.items():
+        tasks, items = counter['tasks'], counter['items']
+        overhead = counter['serialization'] + counter['wait']
+        logger.info(
+            f"IPC {name}: {items} items in {tasks} tasks, {counter['sent'] / tasks:.0f} B sent and "
+            f"{counter['received'] / tasks:.0f} B received per task, {counter['spooled']} B spooled; per item "
+            f"{counter['busy'] / items * 1e6:.0f} us work, {counter['serialization'] / items * 1e6:.0f} us serialization, "
+            f"{counter['wait'] / items * 1e6:.0f} us round trip, overhead {100 * overhead / (overhead + counter['busy']):.0f}%"
+        )
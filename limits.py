@@ -0,0 +1,283 @@
+"""
+Request limits shared by the crawlers
+
+* `MAX_CONCURRENCY` requests in flight per event loop, the connector is capped the same way, so streamed bodies count too
+* `MAX_PER_HOST` open connections per host and session
+* `MAX_RPS` requests per second to the site, one token bucket with one second of burst shared by all processes
+* `ADAPTIVE` replaces the fixed in-flight limit with an AIMD controller, for `requests` and `aiohttp` alike
+
+asyncio primitives are bound to an event loop, so every loop gets its own limiter,
+threads of one process share one set of adaptive slots. The `dump_adaptive_limit` gauge adds up the limits
+of the controllers of all processes and loops, the requests they allow against the site together.
+"""
+import os
+import time
+import asyncio
+import weakref
+import threading
+import contextlib
+import multiprocessing.util
+from collections import Counter
+
+import aiohttp
+
+import metrics
+from logger import get_logger
+from settings import MAX_CONCURRENCY, MAX_PER_HOST, MAX_RPS, ADAPTIVE, ADAPTIVE_START, KEEP_ALIVE, DNS_CACHE_TTL
+
+logger = get_logger(__name__)
+
+controllers = []
+adaptive_limit = metrics.Gauge(
+    'dump_adaptive_limit', 'Requests in flight allowed by the AIMD controllers of all processes', 'client',
+    ('aiohttp', 'requests'),
+)
+
+
+class Attempt:
+    """Outcome of one request made inside a slot, set `status` once the response is there"""
+    status = None
+
+    @property
+    def ok(self):
+        return self.status in (None, 200)
+
+
+class AIMD:
+    """
+    Additive increase / multiplicative decrease of allowed requests in flight
+
+    Every window of `limit` completed requests the limit grows by one if all of them succeeded
+    and window p95 latency stays within `latency_tolerance` of the baseline.
+    A failure cuts the limit by `backoff` right away, at most once per window, so one burst of errors is one cut.
+    """
+
+    def __init__(self, name, start=ADAPTIVE_START, minimum=1, maximum=MAX_CONCURRENCY or 100,
+                 backoff=0.5, latency_tolerance=2.0, min_window=5):
+        self.name = name
+        self.limit = float(min(max(start, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_window = min_window
+        self.latencies = []
+        self.failed = False
+        self.baseline_p95 = None
+        self.decisions = Counter()
+        self.history = [(time.time(), self.limit, 'start')]
+        self.closed = False
+        controllers.append(self)
+        adaptive_limit.add(int(self.limit), self.name)
+
+    def set_limit(self, limit, reason):
+        old, self.limit = self.limit, min(max(limit, self.minimum), self.maximum)
+        self.decisions[reason.split(' ')[0]] += 1
+        self.history.append((time.time(), self.limit, reason))
+        if int(old) != int(self.limit) and not self.closed:
+            adaptive_limit.add(int(self.limit) - int(old), self.name)
+            logger.info(f"{self.name} limit {int(old)} -> {int(self.limit)}: {reason}")
+
+    def close(self):
+        """Takes the limit out of the gauge, the loop or process of the controller is done"""
+        if not self.closed:
+            self.closed = True
+            adaptive_limit.add(-int(self.limit), self.name)
+
+    def update(self, latency, ok):
+        self.latencies.append(latency)
+        if not ok and not self.failed:
+            self.failed = True
+            self.set_limit(self.limit * self.backoff, 'decrease on errors')
+        if len(self.latencies) < max(int(self.limit), self.min_window):
+            return
+
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        if not self.failed:
+            if self.baseline_p95 and p95 > self.baseline_p95 * self.latency_tolerance:
+                self.set_limit(self.limit * self.backoff, f"decrease on p95 latency {p95:.3f}s")
+            else:
+                self.set_limit(self.limit + 1, 'increase')
+            # baseline drifts up slowly, so a permanently slower server is accepted eventually
+            self.baseline_p95 = p95 if self.baseline_p95 is None else min(p95, self.baseline_p95 * 1.1)
+        self.latencies = []
+        self.failed = False
+
+
+class FixedSlots:
+    """Plain semaphore, no limit at all for `limit=0`"""
+
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit) if limit else None
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.semaphore or contextlib.nullcontext():
+            yield Attempt()
+
+
+class AsyncAdaptiveSlots:
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.controller.limit))
+            self.in_flight += 1
+        attempt, start, ok = Attempt(), time.monotonic(), False
+        try:
+            yield attempt
+            ok = attempt.ok
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.controller.update(time.monotonic() - start, ok)
+                self.condition.notify_all()
+
+
+class AdaptiveSlots:
+    """Threaded twin of `AsyncAdaptiveSlots`"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < int(self.controller.limit))
+            self.in_flight += 1
+        attempt, start, ok = Attempt(), time.monotonic(), False
+        try:
+            yield attempt
+            ok = attempt.ok
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.controller.update(time.monotonic() - start, ok)
+                self.condition.notify_all()
+
+
+class SharedTokenBucket:
+    """
+    `rate` tokens per second, at most `burst` at once, for all processes of a run
+
+    Tokens and the last refill live in shared memory created at import, like the metrics, so forked pool workers
+    and their event loops draw from one bucket. A token not there yet is reserved, the caller sleeps until it is due,
+    so waiters are served in order and the lock is held only for the arithmetic.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.state = multiprocessing.Array('d', [self.burst, time.monotonic()])
+
+    def reserve(self):
+        """Takes a token, returns the seconds to wait until it is due"""
+        with self.state.get_lock():
+            tokens, updated = self.state
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+            self.state[0], self.state[1] = tokens, now
+        return max(0.0, -tokens / self.rate)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+rate_limit = SharedTokenBucket(MAX_RPS) if MAX_RPS else None
+
+
+class AsyncLimiter:
+
+    def __init__(self, concurrency=MAX_CONCURRENCY, adaptive=ADAPTIVE):
+        self.slots = AsyncAdaptiveSlots(AIMD('aiohttp')) if adaptive else FixedSlots(concurrency)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        if rate_limit is not None:  # before the slot, so time spent in the bucket is not taken for server latency
+            await rate_limit.acquire()
+        async with self.slots.slot() as attempt:
+            yield attempt
+
+
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_limiter():
+    """Limiter of the running event loop"""
+    loop = asyncio.get_running_loop()
+    if loop not in _limiters:
+        _limiters[loop] = AsyncLimiter()
+    return _limiters[loop]
+
+
+def close_limiter(loop):
+    """Retires the adaptive controller of a loop that is about to close"""
+    limiter = _limiters.pop(loop, None)
+    if limiter is not None and isinstance(limiter.slots, AsyncAdaptiveSlots):
+        limiter.slots.controller.close()
+
+
+def request_slot(url):
+    """`async with request_slot(url) as attempt:` around one aiohttp request"""
+    return get_limiter().slot(url)
+
+
+_sync_slots = None
+_sync_slots_lock = threading.Lock()
+
+
+def _reset_sync_slots():
+    global _sync_slots, _sync_slots_lock
+    _sync_slots, _sync_slots_lock = None, threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_sync_slots)
+
+
+def sync_request_slot(url):
+    """`with sync_request_slot(url) as attempt:` around one requests call, waits for the rate limit first"""
+    global _sync_slots
+    if rate_limit is not None:
+        rate_limit.wait()
+    if not ADAPTIVE:
+        return contextlib.nullcontext(Attempt())
+    with _sync_slots_lock:
+        if _sync_slots is None:
+            _sync_slots = AdaptiveSlots(AIMD('requests'))
+            multiprocessing.util.Finalize(None, _sync_slots.controller.close, exitpriority=10)
+    return _sync_slots.slot()
+
+
+def connector():
+    return aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY,
+        limit_per_host=MAX_PER_HOST,
+        force_close=not KEEP_ALIVE,
+        use_dns_cache=bool(DNS_CACHE_TTL),
+        ttl_dns_cache=DNS_CACHE_TTL or None,
+    )
+
+
+def report():
+    for controller in controllers:
+        decisions = ', '.join(f"{count} {reason}" for reason, count in controller.decisions.items())
+        logger.info(f"{controller.name} adaptive limit {int(controller.limit)} ({decisions or 'no decisions'})")
+    if ADAPTIVE:
+        for client, values in adaptive_limit.summary().items():
+            if values['max']:
+                logger.info(f"{client} adaptive limits of all processes: at most {values['max']} together")
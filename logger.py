@@ -1,4 +1,25 @@
+"""
+Logging shared by all variants
+
+Every logger hands its records to a queue, listener threads of the coordinator format and write them to stderr.
+Threads only pay for putting a record on the queue, worker processes forked by the pools inherit the handler
+and send their records through a pipe to the coordinator instead of writing to stderr on their own.
+
+* `DUMP_LOG_LEVEL` - DEBUG by default
+* `DUMP_LOG_FORMAT=json` - one json object per line instead of colored text
+* `DUMP_LOG_DEBUG_SAMPLE=N` - only every N-th DEBUG record of each logging call, the per-book lines are the bulk of a log
+"""
+import os
+import sys
+import json
+import queue
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+from collections import defaultdict
+
+from settings import LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE
 
 
 class CustomFormatter(logging.Formatter):
@@ -17,17 +38,93 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: red + format + reset,
         logging.CRITICAL: bold_red + format + reset
     }
+    FORMATTERS = {level: logging.Formatter(log_fmt) for level, log_fmt in FORMATS.items()}
+
+    def format(self, record):
+        return self.FORMATTERS.get(record.levelno, self.FORMATTERS[logging.DEBUG]).format(record)
+
+
+class JsonFormatter(logging.Formatter):
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return json.dumps({
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+            'file': record.filename,
+            'line': record.lineno,
+        }, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    """Lets through the first and then every `every`-th DEBUG record of each call site, counted per process"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        self.seen[site] += 1
+        return self.seen[site] % self.every == 1
+
+
+FORMATTERS = {
+    'text': CustomFormatter,
+    'json': JsonFormatter,
+}
+
+
+class ProcessQueueHandler(logging.handlers.QueueHandler):
+    """Records of the process that installed logging go to a local queue, those of forked workers through a pipe"""
+
+    def __init__(self, local, shared):
+        super().__init__(local)
+        self.shared = shared
+        self.pid = os.getpid()
+
+    def enqueue(self, record):
+        (self.queue if os.getpid() == self.pid else self.shared).put_nowait(record)
+
+
+_handler = None
+_listeners = []
+
+
+def stop_listeners():
+    if _handler is not None and _handler.pid == os.getpid():
+        for listener in _listeners:
+            listener.stop()
+
+
+def install():
+    """Queue handler on the root logger and the listener threads, once per run, forked processes inherit the handler"""
+    global _handler
+    if _handler is not None:
+        return
+    if LOG_FORMAT not in FORMATTERS:
+        raise ValueError(f"Unknown log format {LOG_FORMAT}, expected {', '.join(FORMATTERS)}")
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(FORMATTERS[LOG_FORMAT]())
+    # two queues, a listener each: records of this process skip the pipe and its pickling, about a quarter
+    # of a logging call, forked workers can only reach us through the pipe; the stream handler lock keeps lines whole
+    _handler = ProcessQueueHandler(queue.SimpleQueue(), multiprocessing.Queue())
+    _handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+    logging.getLogger().addHandler(_handler)
+    for records in (_handler.queue, _handler.shared):
+        _listeners.append(logging.handlers.QueueListener(records, stream_handler))
+        _listeners[-1].start()
+    atexit.register(stop_listeners)
 
 
 def get_logger(name):
+    install()
     logger = logging.getLogger(name)
-    c_handler = logging.StreamHandler()
-    c_handler.setFormatter(CustomFormatter())
-    logger.addHandler(c_handler)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
     return logger
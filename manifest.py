@@ -0,0 +1,151 @@
+"""
+Per-book completion manifest, makes dumps resumable
+
+The manifest is an append-only json lines file inside the dump directory, every line is one state change of one book.
+Lines are short and written with a single `os.write` on an `O_APPEND` descriptor,
+so threads and pool processes can share one file without locks.
+"""
+import os
+import json
+import time
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_FILE_NAME = '.manifest.jsonl'
+ABOUT_FILE_NAME = 'about.txt'
+TEXT_FILE_NAME = 'result.txt'
+
+LISTED = 'listed'
+ABOUT_FETCHED = 'about_fetched'
+TEXT_FETCHED = 'text_fetched'
+WRITTEN = 'written'
+VERIFIED = 'verified'
+PAGE_FAILED = 'page_failed'  # a listing page, its books are unknown until it is fetched
+PAGE_PARSED = 'page_parsed'
+PAGE_STATES = (PAGE_FAILED, PAGE_PARSED)
+
+FETCHED_STATES = {
+    ABOUT_FILE_NAME: ABOUT_FETCHED,
+    TEXT_FILE_NAME: TEXT_FETCHED,
+}
+
+
+def file_size(book_dir, file_name):
+    return os.path.getsize(os.path.join(book_dir, file_name))
+
+
+class Manifest:
+
+    def __init__(self, dump_dir, size=None):
+        self.dump_dir = dump_dir
+        self.size = size or file_size  # size of a written file, OSError if it is missing
+        self.path = os.path.join(dump_dir, MANIFEST_FILE_NAME)
+        self.fd = None
+        self.books = {}
+        self.pages = {}
+        self.load()
+
+    def load(self):
+        """(Re)reads manifest from disk, records written by other processes included"""
+        self.books = {}
+        self.pages = {}
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # torn last line after a crash
+                    continue
+                self.apply(record)
+        return self
+
+    def apply(self, record):
+        if record['state'] in PAGE_STATES:
+            self.pages[record['url']] = record['state']
+            return
+        book = self.books.setdefault(record['url'], {'written': {}})
+        state = record['state']
+        if state == LISTED:
+            book['name'] = record['name']
+            if record.get('tag') and record['tag'] not in book.setdefault('tags', []):
+                book['tags'].append(record['tag'])
+        elif state == WRITTEN:
+            book['written'][record['file']] = record.get('size')
+        elif state == VERIFIED:
+            book[VERIFIED] = True
+        else:
+            book[state] = record.get('size')
+
+    def mark(self, book_url, state, **info):
+        record = dict(url=book_url, state=state, ts=round(time.time(), 3), **info)
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.apply(record)
+
+    def listed(self, book_url, book_name, tag=None):
+        self.mark(book_url, LISTED, name=book_name, **({'tag': tag} if tag else {}))
+
+    def page_parsed(self, page_url):
+        self.mark(page_url, PAGE_PARSED)
+
+    def page_failed(self, page_url):
+        self.mark(page_url, PAGE_FAILED)
+
+    def failed_pages(self):
+        """Listing pages that failed and were not parsed since"""
+        return [url for url, state in self.pages.items() if state == PAGE_FAILED]
+
+    def fetched(self, book_url, file_name, size=None):
+        self.mark(book_url, FETCHED_STATES[file_name], size=size)
+
+    def written(self, book_url, book_dir, file_name, size=None):
+        self.mark(book_url, WRITTEN, file=file_name, size=self.size(book_dir, file_name) if size is None else size)
+
+    def is_written(self, book_url, book_dir, file_name):
+        """File was fetched, written completely and is still in the output"""
+        book = self.books.get(book_url)
+        if not book or FETCHED_STATES[file_name] not in book or file_name not in book['written']:
+            return False
+        fetched_size, written_size = book[FETCHED_STATES[file_name]], book['written'][file_name]
+        try:
+            size = self.size(book_dir, file_name)
+        except OSError:
+            return False
+        return size == written_size and fetched_size in (None, size)
+
+    def needs(self, book_url, book_dir, file_name):
+        return not self.is_written(book_url, book_dir, file_name)
+
+    def is_verified(self, book_url, book_dir):
+        book = self.books.get(book_url)
+        return bool(book and book.get(VERIFIED)) and not any(
+            self.needs(book_url, book_dir, file_name) for file_name in FETCHED_STATES
+        )
+
+    def verify(self, book_url, book_dir):
+        if self.is_verified(book_url, book_dir):
+            return True
+        if any(self.needs(book_url, book_dir, file_name) for file_name in FETCHED_STATES):
+            return False
+        self.mark(book_url, VERIFIED)
+        return True
+
+    def verify_all(self):
+        """Checks every listed book against the output, returns verified and listed counts and failed pages"""
+        self.load()
+        listed = {url: book['name'] for url, book in self.books.items() if 'name' in book}
+        verified = sum(self.verify(url, os.path.join(self.dump_dir, name)) for url, name in listed.items())
+        logger.info(f"{verified}/{len(listed)} books verified, manifest {self.path}")
+        failed_pages = self.failed_pages()
+        if failed_pages:
+            logger.error(f"{len(failed_pages)} listing pages failed, their books are missing: {', '.join(failed_pages)}")
+        return verified, len(listed), failed_pages
+
+    def complete(self):
+        """Every listed book verified and no listing page failed"""
+        verified, listed, failed_pages = self.verify_all()
+        return verified == listed and not failed_pages
@@ -0,0 +1,240 @@
+"""
+Metrics registry shared by all variants
+
+Counters, gauges and histograms keep their values in shared memory created at import, like the other module counters,
+so threads and forked pool processes feed the same numbers. Metrics are declared by the module that measures,
+with every label value known up front.
+
+At the end of a run `metrics.json` in the dump directory gets a summary, with histogram percentiles estimated
+from the buckets, and `DUMP_METRICS_TEXTFILE` a Prometheus textfile for the node exporter textfile collector.
+"""
+import os
+import json
+import time
+import bisect
+import multiprocessing
+
+from logger import get_logger
+from settings import METRICS_TEXTFILE
+
+logger = get_logger(__name__)
+
+METRICS_FILE_NAME = 'metrics.json'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def number(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def format_value(value):
+    return repr(number(value))
+
+
+class Metric:
+    kind = None
+    slots = 1
+
+    def __init__(self, name, help, label=None, values=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = tuple(values) if label else ('',)
+        self.index = {value: i * self.slots for i, value in enumerate(self.values)}
+        self.data = multiprocessing.Array('d', len(self.values) * self.slots)
+        registry.append(self)
+
+    def reset(self):
+        self.data = multiprocessing.Array('d', len(self.data))
+
+    def offset(self, value):
+        return self.index[value if self.label else '']
+
+    def labels(self, value):
+        return {self.label: value} if self.label else {}
+
+    def header(self, kind=None):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind or self.kind}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, label=''):
+        with self.data.get_lock():
+            self.data[self.offset(label)] += amount
+
+    def value(self, label=''):
+        return number(self.data[self.offset(label)])
+
+    def summary(self):
+        return {value: self.value(value) for value in self.values}
+
+    def lines(self):
+        return self.header() + [
+            f"{self.name}{format_labels(self.labels(value))} {format_value(self.data[self.offset(value)])}"
+            for value in self.values
+        ]
+
+
+class Gauge(Metric):
+    """Current value and the highest it has been"""
+    kind = 'gauge'
+    slots = 2
+
+    def add(self, amount, label=''):
+        offset = self.offset(label)
+        with self.data.get_lock():
+            self.data[offset] += amount
+            self.data[offset + 1] = max(self.data[offset + 1], self.data[offset])
+
+    def inc(self, label=''):
+        self.add(1, label)
+
+    def dec(self, label=''):
+        self.add(-1, label)
+
+    def set(self, amount, label=''):
+        offset = self.offset(label)
+        with self.data.get_lock():
+            self.data[offset] = amount
+            self.data[offset + 1] = max(self.data[offset + 1], amount)
+
+    def summary(self):
+        return {value: {'current': number(self.data[self.offset(value)]), 'max': number(self.data[self.offset(value) + 1])}
+                for value in self.values}
+
+    def lines(self):
+        lines = self.header()
+        for value in self.values:
+            lines.append(f"{self.name}{format_labels(self.labels(value))} {format_value(self.data[self.offset(value)])}")
+        lines += [f"# HELP {self.name}_max Highest {self.name} of the run", f"# TYPE {self.name}_max gauge"]
+        for value in self.values:
+            lines.append(
+                f"{self.name}_max{format_labels(self.labels(value))} {format_value(self.data[self.offset(value) + 1])}"
+            )
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, self.label)
+
+
+class Histogram(Metric):
+    """Seconds in `BUCKETS`, each label keeps bucket counts, then sum and count"""
+    kind = 'histogram'
+    slots = len(BUCKETS) + 3
+
+    def observe(self, seconds, label=''):
+        offset = self.offset(label)
+        with self.data.get_lock():
+            self.data[offset + bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.data[offset + len(BUCKETS) + 1] += seconds
+            self.data[offset + len(BUCKETS) + 2] += 1
+
+    def time(self, label=''):
+        return Timer(self, label)
+
+    def read(self, value):
+        offset = self.offset(value)
+        counts = self.data[offset:offset + len(BUCKETS) + 1]
+        return counts, self.data[offset + len(BUCKETS) + 1], self.data[offset + len(BUCKETS) + 2]
+
+    def quantile(self, counts, total, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        rank, seen = q * total, 0
+        for bound, count in zip(BUCKETS + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        summary = {}
+        for value in self.values:
+            counts, seconds, total = self.read(value)
+            if total:
+                summary[value] = {
+                    'count': int(total), 'sum': round(seconds, 6), 'mean': round(seconds / total, 6),
+                    **{f"p{int(q * 100)}": self.quantile(counts, total, q) for q in (0.5, 0.9, 0.99)},
+                }
+        return summary
+
+    def lines(self):
+        lines = self.header()
+        for value in self.values:
+            counts, seconds, total = self.read(value)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                labels = dict(self.labels(value), le=bound)
+                lines.append(f"{self.name}_bucket{format_labels(labels)} {format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels(value))} {format_value(seconds)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels(value))} {format_value(total)}")
+        return lines
+
+
+class Stopwatch:
+    """Adds up the time spent inside `with` blocks, e.g. the writes of one streamed file"""
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed += time.perf_counter() - self.start
+
+
+def reset():
+    """Zeroed values of this process and the processes it forks from now on, siblings keep theirs"""
+    for metric in registry:
+        metric.reset()
+
+
+def summary():
+    return {metric.name: {'type': metric.kind, 'help': metric.help, 'values': metric.summary()} for metric in registry}
+
+
+def exposition():
+    return '\n'.join(line for metric in registry for line in metric.lines()) + '\n'
+
+
+def write(dump_dir, file_name=METRICS_FILE_NAME, textfile=METRICS_TEXTFILE):
+    """Writes the JSON summary into the dump directory and the Prometheus textfile if configured"""
+    with open(os.path.join(dump_dir, file_name), 'wt', encoding='utf-8') as f:
+        json.dump(summary(), f, indent=2, ensure_ascii=False)
+    if textfile:
+        # the collector may read at any moment, it must never see a half written file
+        with open(textfile + '.tmp', 'wt', encoding='utf-8') as f:
+            f.write(exposition())
+        os.replace(textfile + '.tmp', textfile)
+
+
+def report():
+    for metric in registry:
+        if metric.kind == 'histogram':
+            for value, stats in metric.summary().items():
+                logger.info(
+                    f"{metric.name} {value}: {stats['count']} in {stats['sum']:.2f}s, mean {stats['mean'] * 1000:.1f} ms, "
+                    f"p50 <= {stats['p50'] * 1000:g} ms, p99 <= {stats['p99'] * 1000:g} ms"
+                )
@@ -0,0 +1,254 @@
+"""
+Local stand-in for translatedby.com
+
+Serves just enough of the site for the dump scripts: tag listing with `spager` pagination,
+`translations-list` pages, `stats/` about pages and `.txt` bodies.
+Point the scripts to it with `DUMP_SITE_BASE_URL=http://127.0.0.1:8000/`
+"""
+import json
+import math
+import zlib
+import time
+import random
+import argparse
+import threading
+from html import escape
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua. Съешь же ещё этих мягких французских булок, да выпей чаю.\n"
+)
+
+
+class MockSite:
+    """Fake site content and counters, shared between handler threads"""
+
+    def __init__(self, books=100, per_page=20, min_body_size=16 * 1024, max_body_size=64 * 1024,
+                 latency=0.0, latency_jitter=0.0, error_rate=0.0, retry_after=None, seed=0):
+        if math.ceil(books / per_page) < 2:
+            raise ValueError("At least two listing pages are required, scripts rely on `spager` links")
+        self.books = books
+        self.per_page = per_page
+        self.pages = math.ceil(books / per_page)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        sizes = random.Random(seed)
+        self.body_sizes = [sizes.randint(min_body_size, max_body_size) for _ in range(books)]
+        self.text = (LOREM * (max_body_size // len(LOREM) + 1)).encode('utf-8')[:max_body_size]
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0, 'connections': 0, 'errors': 0, 'not_modified': 0, 'bytes_sent': 0, 'started': time.time(),
+                'first_text': None,  # seconds from reset to the first `.txt` body, time to first book byte
+            }
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def mark_first(self, key):
+        with self.lock:
+            if self.stats[key] is None:
+                self.stats[key] = time.time() - self.stats['started']
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        if self.latency + jitter > 0:
+            time.sleep(self.latency + jitter)
+
+    @staticmethod
+    def book_slug(index):
+        return f"book-{index:05d}"
+
+    @staticmethod
+    def book_name(index):
+        return f"Книга {index:05d} GURPS"
+
+    def book_index(self, slug):
+        if not slug.startswith('book-') or not slug[5:].isdigit():
+            return None
+        index = int(slug[5:])
+        return index if index < self.books else None
+
+    def listing(self, tag, page):
+        first = (page - 1) * self.per_page
+        items = "\n".join(
+            f'<dt><a href="/you/{self.book_slug(i)}/trans/">{escape(self.book_name(i))}</a></dt>'
+            f'<dd>Translation of book {i}</dd>'
+            for i in range(first, min(first + self.per_page, self.books))
+        )
+        pager = " ".join(
+            f'<a href="/you/tags/{escape(tag)}/?page={i}">{i}</a>' for i in range(2, self.pages + 1) if i != page
+        )
+        if page != 1:
+            pager = f'<a href="/you/tags/{escape(tag)}/">1</a> ' + pager
+        return (
+            f'<html><head><title>{escape(tag)}</title></head><body>\n'
+            f'<dl class="translations-list">\n{items}\n</dl>\n'
+            f'<div class="spager">{pager}</div>\n'
+            f'</body></html>\n'
+        )
+
+    def about(self, index):
+        return (
+            f'<html><head><title>{escape(self.book_name(index))}</title></head><body>\n'
+            f'<div id="about-translation"><h2>About</h2>'
+            f'<blockquote>\n  About translation of book {index}\n</blockquote></div>\n'
+            f'</body></html>\n'
+        )
+
+    def body(self, index):
+        return self.text[:self.body_sizes[index]]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes, Nagle stalls kept-alive connections
+    site = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_body(self, status, body, content_type='text/html; charset=utf-8', cacheable=False, retry_after=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if cacheable:
+            etag = f'"{zlib.crc32(body):08x}-{len(body)}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.site.count('not_modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+        self.send_response(status)
+        if cacheable:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.site.last_modified)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.site.count('bytes_sent', len(body))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['_stats']:
+            if 'reset' in parse_qs(url.query):
+                self.site.reset()
+            stats = dict(self.site.stats, elapsed=time.time() - self.site.stats['started'])
+            return self.send_body(200, json.dumps(stats), 'application/json')
+
+        self.site.count('requests')
+        if not parts:
+            return self.send_body(200, '<html><body>Mock translatedby.com</body></html>')
+
+        self.site.delay()
+        if self.site.should_fail():
+            self.site.count('errors')
+            return self.send_body(503, 'Service Unavailable', 'text/plain', retry_after=self.site.retry_after)
+
+        if len(parts) == 3 and parts[:2] == ['you', 'tags']:
+            page = parse_qs(url.query).get('page', ['1'])[0]
+            if page.isdigit() and 1 <= int(page) <= self.site.pages:
+                return self.send_body(200, self.site.listing(parts[2], int(page)), cacheable=True)
+        elif len(parts) == 3 and parts[0] == 'you':
+            index = self.site.book_index(parts[1])
+            if index is not None and parts[2] == 'stats':
+                return self.send_body(200, self.site.about(index), cacheable=True)
+            if index is not None and parts[2] == '.txt':
+                self.site.mark_first('first_text')
+                return self.send_body(200, self.site.body(index), 'text/plain; charset=utf-8', cacheable=True)
+        self.send_body(404, 'Not Found', 'text/plain')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # async variants open a lot of connections at once
+
+    def process_request(self, request, client_address):
+        """Called once per accepted connection, so `connections` counts TCP handshakes"""
+        self.RequestHandlerClass.site.count('connections')
+        super().process_request(request, client_address)
+
+
+def make_server(host='127.0.0.1', port=0, **site_options):
+    """Build mock server, `port=0` picks a free port"""
+    handler = type('Handler', (MockHandler, ), {'site': MockSite(**site_options)})
+    return MockServer((host, port), handler)
+
+
+def serve_in_thread(host='127.0.0.1', port=0, **site_options):
+    """Start mock server in a daemon thread, returns server and its base url"""
+    server = make_server(host, port, **site_options)
+    threading.Thread(target=server.serve_forever, name='MockServer', daemon=True).start()
+    return server, f"http://{server.server_address[0]}:{server.server_address[1]}/"
+
+
+def add_site_arguments(parser):
+    parser.add_argument('--books', type=int, default=100, help='number of books in the tag')
+    parser.add_argument('--per-page', type=int, default=20, help='books per listing page')
+    parser.add_argument('--min-body-size', type=int, default=16 * 1024, help='min `.txt` body size, bytes')
+    parser.add_argument('--max-body-size', type=int, default=64 * 1024, help='max `.txt` body size, bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay, seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='random +- delay, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--retry-after', type=int, help='`Retry-After` seconds sent with 503')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def site_options(args):
+    return {
+        'books': args.books,
+        'per_page': args.per_page,
+        'min_body_size': args.min_body_size,
+        'max_body_size': args.max_body_size,
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'error_rate': args.error_rate,
+        'retry_after': args.retry_after,
+        'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, **site_options(args))
+    logger.info(f"Serving {server.RequestHandlerClass.site.books} books on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Where dumped files go
+
+`DUMP_OUTPUT=dirs` writes a directory per book, `DUMP_OUTPUT=pack` appends every file to `books.pack`
+in the dump directory, see `pack`, `DUMP_OUTPUT=blobs` links book directories to a blob store shared by dumps, see `blobs`. Stages write a file to `output.path(...)` and hand it over with
+`output.commit(...)`, which marks it written in the manifest once it is where it belongs.
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import pack
+import blobs
+import compression
+from logger import get_logger
+from settings import OUTPUT, RESUME, PACK_BATCH_BYTES, PACK_FLUSH_INTERVAL, BLOB_DIR
+
+logger = get_logger(__name__)
+
+SPOOL_DIR_NAME = '.spool'
+
+
+class DirectoryOutput:
+    """One directory per book, files are written in place"""
+
+    def __init__(self, dump_dir, resume=RESUME):
+        self.dump_dir = dump_dir
+        self.resume = resume  # book directories of an earlier run may be there
+        self.manifest = None
+
+    def prepare(self, book_dir):
+        os.makedirs(book_dir, exist_ok=self.resume)
+
+    def path(self, book_dir, file_name, suffix=''):
+        """Where to write a file, `suffix` of its compression"""
+        return os.path.join(book_dir, file_name + suffix)
+
+    def find(self, book_dir, file_name):
+        """Path of a written file whatever its compression, OSError if there is none"""
+        for suffix in ('',) + compression.SUFFIXES:
+            path = os.path.join(book_dir, file_name + suffix)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(os.path.join(book_dir, file_name))
+
+    def size(self, book_dir, file_name):
+        """Size of a written file as stored, OSError if there is none"""
+        return os.path.getsize(self.find(book_dir, file_name))
+
+    def read(self, book_dir, file_name):
+        """Body of a written file, decompressed"""
+        with open(self.find(book_dir, file_name), 'rb') as f:
+            return compression.decompress(f.read())
+
+    def remove_others(self, book_dir, file_name, path):
+        for suffix in ('',) + compression.SUFFIXES:  # left by a run with another compression
+            other = os.path.join(book_dir, file_name + suffix)
+            if other != path and os.path.exists(other):
+                os.remove(other)
+
+    def commit(self, book_url, book_dir, file_name, path):
+        self.remove_others(book_dir, file_name, path)
+        self.manifest.written(book_url, book_dir, file_name)
+
+    def close(self):
+        pass
+
+
+class PackOutput(DirectoryOutput):
+    """
+    Files are spooled next to the pack and appended to it in batches
+
+    A file waits until `PACK_BATCH_BYTES` are pending or the oldest pending one is `PACK_FLUSH_INTERVAL` seconds old,
+    then the whole batch is appended in one locked run. Files are marked written only once they are in the pack,
+    so an interrupted run refetches what was still pending.
+    """
+
+    def __init__(self, dump_dir, resume=RESUME):
+        super().__init__(dump_dir, resume)
+        self.spool_dir = os.path.join(dump_dir, SPOOL_DIR_NAME)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        pack_path = os.path.join(dump_dir, pack.PACK_FILE_NAME)
+        self.reader = pack.PackReader(pack_path)
+        self.writer = pack.PackWriter(pack_path)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.oldest = None
+
+    def prepare(self, book_dir):
+        pass
+
+    def path(self, book_dir, file_name, suffix=''):
+        fd, path = tempfile.mkstemp(prefix=f"{file_name}.", dir=self.spool_dir)
+        os.close(fd)
+        return path
+
+    def entry(self, book_dir, file_name):
+        name = os.path.basename(book_dir)
+        entry = self.reader.entry(name, file_name) or self.reader.refresh().entry(name, file_name)
+        if entry is None:
+            raise FileNotFoundError(f"{name}/{file_name} is not in {self.reader.path}")
+        return entry
+
+    def size(self, book_dir, file_name):
+        return self.entry(book_dir, file_name)['size']
+
+    def read(self, book_dir, file_name):
+        return compression.decompress(self.reader.read(self.entry(book_dir, file_name)))
+
+    def commit(self, book_url, book_dir, file_name, path):
+        record = pack.record(dict(url=book_url, name=os.path.basename(book_dir), file=file_name), path)
+        with self.lock:
+            self.pending.append((record, book_url, book_dir, file_name))
+            self.pending_bytes += os.path.getsize(path)
+            self.oldest = self.oldest or time.monotonic()
+            if self.pending_bytes < PACK_BATCH_BYTES and time.monotonic() - self.oldest < PACK_FLUSH_INTERVAL:
+                return
+            batch = self.take()
+        self.write(batch)
+
+    def take(self):
+        batch, self.pending, self.pending_bytes, self.oldest = self.pending, [], 0, None
+        return batch
+
+    def write(self, batch):
+        entries = self.writer.append([record for record, *_ in batch])
+        for (record, book_url, book_dir, file_name), entry in zip(batch, entries):
+            self.manifest.written(book_url, book_dir, file_name, entry['size'])
+            os.remove(record[2])
+
+    def close(self):
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.write(batch)
+        self.writer.close()
+
+
+class BlobOutput(DirectoryOutput):
+    """Book directories of hardlinks to `BLOB_DIR`, files are written next to the store and moved or dropped there"""
+
+    def __init__(self, dump_dir, resume=RESUME):
+        super().__init__(dump_dir, resume)
+        self.store = blobs.BlobStore(BLOB_DIR)
+
+    def path(self, book_dir, file_name, suffix=''):
+        return self.store.temp_path(prefix=f"{file_name}.", suffix=suffix)
+
+    def commit(self, book_url, book_dir, file_name, path):
+        suffix = next((suffix for suffix in compression.SUFFIXES if path.endswith(suffix)), '')
+        target = os.path.join(book_dir, file_name + suffix)
+        self.store.link(path, target)
+        self.remove_others(book_dir, file_name, target)
+        self.manifest.written(book_url, book_dir, file_name)
+
+
+OUTPUTS = {
+    'dirs': DirectoryOutput,
+    'pack': PackOutput,
+    'blobs': BlobOutput,
+}
+
+
+def make_output(dump_dir, resume=RESUME):
+    if OUTPUT not in OUTPUTS:
+        raise ValueError(f"Unknown output {OUTPUT}, expected {', '.join(OUTPUTS)}")
+    return OUTPUTS[OUTPUT](dump_dir, resume)
+
+
+def recover(dump_dir):
+    """Repairs what an interrupted run left behind, run by the coordinator before any worker starts"""
+    if OUTPUT == 'pack':
+        pack.recover(os.path.join(dump_dir, pack.PACK_FILE_NAME))
+        shutil.rmtree(os.path.join(dump_dir, SPOOL_DIR_NAME), ignore_errors=True)
@@ -0,0 +1,236 @@
+"""
+Single-file dump container
+
+`books.pack` is append-only, every record is a header, a json meta with book url, name and file name, and the body:
+
+    magic b'DPK1' | meta length u32 | body length u64 | crc32 of meta and body u32 | meta | body
+
+`books.pack.idx` has one json line per complete record with the body offset, so a lookup by url or name is a dict access.
+Records are appended under an exclusive `flock`, the index line only after its record, so an interrupted run
+leaves at most a torn tail that `recover` cuts off; a lost index is rebuilt by scanning the pack.
+
+    python pack.py list GURPS_2024-01-31_sync/books.pack
+    python pack.py extract GURPS_2024-01-31_sync/books.pack --book "Книга 00001 GURPS" --output out
+"""
+import os
+import sys
+import json
+import zlib
+import fcntl
+import struct
+import shutil
+import argparse
+import threading
+
+import compression
+from logger import get_logger
+from settings import CHUNK_SIZE
+
+logger = get_logger(__name__)
+
+PACK_FILE_NAME = 'books.pack'
+INDEX_SUFFIX = '.idx'
+MAGIC = b'DPK1'
+HEADER = struct.Struct('<4sIQI')
+
+
+def record(meta, body_path):
+    """Record ready to append, checksummed before the pack is locked"""
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    crc = zlib.crc32(meta_bytes)
+    with open(body_path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return meta, meta_bytes, body_path, crc
+
+
+def index_lines(entries):
+    return b''.join((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8') for entry in entries)
+
+
+class PackReader:
+    """Random access to the books of a pack through its index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.entries = []
+        self.by_url = {}
+        self.by_name = {}
+        self.index_size = 0
+        self.refresh()
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.by_url.setdefault(entry['url'], {})[entry['file']] = entry
+        self.by_name.setdefault(entry['name'], {})[entry['file']] = entry
+
+    def refresh(self):
+        """Reads index lines appended since the last call, the index is rebuilt from the pack if missing"""
+        if not os.path.exists(self.index_path):
+            if os.path.exists(self.path):
+                for entry in scan(self.path):
+                    self.add(entry)
+            return self
+        with open(self.index_path, 'rb') as f:
+            f.seek(self.index_size)
+            for line in f:
+                if not line.endswith(b'\n'):  # line being written right now
+                    break
+                self.index_size += len(line)
+                self.add(json.loads(line))
+        return self
+
+    def files(self, book):
+        """{file name: entry} of a book given by url or name"""
+        return self.by_url.get(book) or self.by_name.get(book) or {}
+
+    def entry(self, book, file_name):
+        return self.files(book).get(file_name)
+
+    def read(self, entry):
+        """Body of an entry as stored, see `compression.decompress`"""
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            return f.read(entry['size'])
+
+    def copy(self, entry, target):
+        """Writes the decompressed body of an entry into an open binary file"""
+        decompressor = compression.Decompressor()
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            left = entry['size']
+            while left:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                if not chunk:
+                    raise ValueError(f"{self.path} is truncated at {entry['name']}/{entry['file']}")
+                target.write(decompressor.decompress(chunk))
+                left -= len(chunk)
+        target.write(decompressor.flush())
+
+    def extract(self, entry, output_dir):
+        book_dir = os.path.join(output_dir, entry['name'])
+        os.makedirs(book_dir, exist_ok=True)
+        with open(os.path.join(book_dir, entry['file']), 'wb') as f:
+            self.copy(entry, f)
+
+
+def scan(path, offset=0):
+    """Yields index entries of valid records from `offset` on, stops at the first torn or corrupt one"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset + HEADER.size <= size:
+            magic, meta_size, body_size, crc = HEADER.unpack(f.read(HEADER.size))
+            body_offset = offset + HEADER.size + meta_size
+            if magic != MAGIC or body_offset + body_size > size:
+                return
+            meta = f.read(meta_size)
+            check = zlib.crc32(meta)
+            left = body_size
+            while left:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                check = zlib.crc32(chunk, check)
+                left -= len(chunk)
+            if check != crc:
+                return
+            yield dict(json.loads(meta), offset=body_offset, size=body_size, crc=crc)
+            offset = body_offset + body_size
+
+
+def recover(path):
+    """Cuts a torn tail off the pack and indexes complete records the index misses, run before writers start"""
+    if not os.path.exists(path):
+        return
+    reader = PackReader(path)
+    end = max((entry['offset'] + entry['size'] for entry in reader.entries), default=0)
+    missing = list(scan(path, end))
+    if missing:
+        with open(path + INDEX_SUFFIX, 'ab') as f:
+            f.write(index_lines(missing))
+        end = missing[-1]['offset'] + missing[-1]['size']
+        logger.warning(f"{path}: {len(missing)} records were missing from the index")
+    if os.path.getsize(path) > end:
+        logger.warning(f"{path}: cutting {os.path.getsize(path) - end} bytes of an interrupted write")
+        os.truncate(path, end)
+
+
+class PackWriter:
+    """
+    Appends records for the threads of one process, every process opens the pack on its own,
+    `flock` only excludes other open file descriptions
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pack = self.index = None
+
+    def open(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pack = open(self.path, 'ab')
+            self.index = open(self.index_path, 'ab')
+
+    def append(self, records):
+        """Writes records made by `record` as one sequential run, returns their index entries"""
+        entries = []
+        with self.lock:
+            self.open()
+            fcntl.flock(self.pack.fileno(), fcntl.LOCK_EX)
+            try:
+                offset = os.fstat(self.pack.fileno()).st_size
+                for meta, meta_bytes, body_path, crc in records:
+                    size = os.path.getsize(body_path)
+                    self.pack.write(HEADER.pack(MAGIC, len(meta_bytes), size, crc))
+                    self.pack.write(meta_bytes)
+                    with open(body_path, 'rb') as body:
+                        shutil.copyfileobj(body, self.pack, CHUNK_SIZE)
+                    offset += HEADER.size + len(meta_bytes)
+                    entries.append(dict(meta, offset=offset, size=size, crc=crc))
+                    offset += size
+                self.pack.flush()
+                self.index.write(index_lines(entries))
+                self.index.flush()
+            finally:
+                fcntl.flock(self.pack.fileno(), fcntl.LOCK_UN)
+        return entries
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.pack.close()
+            self.index.close()
+            self.pid = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('list', 'extract', 'cat'))
+    parser.add_argument('pack', help=f'path to {PACK_FILE_NAME}')
+    parser.add_argument('--book', help='book url or name, all books if omitted')
+    parser.add_argument('--file', help='only this file of a book, e.g. result.txt')
+    parser.add_argument('--output', default='.', help='directory to extract to')
+    args = parser.parse_args()
+
+    reader = PackReader(args.pack)
+    if args.book:
+        entries = list(reader.files(args.book).values())
+        if not entries:
+            sys.exit(f"No book {args.book} in {args.pack}")
+    else:
+        entries = reader.entries
+    entries = [entry for entry in entries if not args.file or entry['file'] == args.file]
+
+    for entry in entries:
+        if args.command == 'list':
+            print(f"{entry['size']:>10}  {entry['name']}/{entry['file']}  {entry['url']}")
+        elif args.command == 'extract':
+            reader.extract(entry, args.output)
+        else:
+            reader.copy(entry, sys.stdout.buffer)
+
+
+if __name__ == "__main__":
+    main()
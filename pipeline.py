@@ -0,0 +1,824 @@
+"""
+Staged dump pipeline shared by all variants
+
+    discover tags -> fetch_page -> parse_page -> books -> fetch_about -> write_about -> catalog
+                                                  -> text -----------------------/
+                                                          -> index
+                                                          -> history
+
+Every stage is placed on a backend: `inline` (the coordinator thread), `threads`, `processes`,
+`asyncio` (aiohttp, one session) or `processes-asyncio` (aiohttp on a persistent loop inside every worker process).
+Stages are connected by bounded queues of `DUMP_QUEUE_SIZE` items, so a slow stage holds back
+the ones before it instead of buffering the whole site in memory.
+
+The variant scripts are presets of placements, `DUMP_PIPELINE` overrides any of them:
+
+    DUMP_PIPELINE=parse_page=processes:4,text=threads:32 python thread_dump.py
+"""
+import os
+import re
+import sys
+import time
+import pickle
+import hashlib
+import asyncio
+import datetime
+import multiprocessing.util
+from collections import Counter
+from urllib.parse import urljoin, urlsplit, urlunsplit, quote, unquote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import aiohttp
+import requests
+from aiofile import async_open
+
+import retry
+import limits
+import ipc
+import extract
+import outputs
+import catalog
+import search
+import history
+import compression
+import blobs
+import metrics
+import tracer
+import connections
+import http_cache
+from logger import get_logger
+from retry import get_response_with_retry, async_get_response_with_retry
+from settings import SITE_BASE_URL, TIMESTAMP, RESUME, CHUNK_SIZE, MAX_CONCURRENCY, PIPELINE, QUEUE_SIZE
+from settings import PROCESS_BATCH_SIZE, BATCH_TIMEOUT, CATALOG, SEARCH_INDEX, HISTORY_DIR, TAGS
+from manifest import Manifest, ABOUT_FILE_NAME, TEXT_FILE_NAME
+
+if not TAGS:
+    raise ValueError("DUMP_TAGS has no tag, expected comma separated tags like GURPS,Fantasy")
+if CATALOG in ('0', '1'):
+    raise ValueError(f"DUMP_CATALOG={CATALOG} is not a path, expected a catalog file like catalog.sqlite, empty turns it off")
+DUMP_NAME = '+'.join(TAGS)
+
+logger = get_logger(__name__)
+
+# metrics, the rate limit, the retry budget and the log queue reach worker processes only by being forked,
+# the platform default may be spawn or forkserver
+FORK = multiprocessing.get_context('fork')
+
+dump_dir = None
+output = None
+manifest = None
+book_catalog = None  # coordinator only
+codec = compression.make_codec()
+suffix = codec.suffix if codec else ''
+search_index = None  # coordinator only
+book_history = None  # coordinator only
+planned = {}  # book url -> tags it was listed under in the current `dump`, coordinator only
+
+
+def setup(dir_name, resume=RESUME):
+    """Dump directory, output and manifest of this process, worker processes run it as pool initializer"""
+    global dump_dir, output, manifest
+    dump_dir, output = dir_name, outputs.make_output(dir_name, resume)
+    manifest = output.manifest = Manifest(dir_name, size=output.size)
+    connections.install_dns_cache()
+    # pool workers leave through os._exit, atexit handlers never run, finalizers do
+    multiprocessing.util.Finalize(None, output.close, exitpriority=5)
+
+
+def checks(site_url, dir_name):
+    """Dummy checks"""
+    response = connections.session().get(site_url)
+    if response.status_code != requests.codes.ok:
+        logger.error(f"Site {site_url} is down, try later")
+        return False
+    if os.path.isdir(dir_name) and not RESUME:
+        logger.error(f"Directory {dir_name} already exists")
+        return False
+    return True
+
+
+# Stages take one item and return a list of items for the next stages.
+# Pages travel as raw body and encoding, they are decoded by the stage that parses them.
+
+def body(response):
+    """Raw body and encoding of a `requests` response, the same encoding `response.text` would use"""
+    return response.content, response.encoding or response.apparent_encoding
+
+
+async def async_body(response):
+    return await response.read(), response.get_encoding()
+
+
+def validators(response):
+    return response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def fetch_page(page_url):
+    """page url -> (page url, body, encoding)"""
+    logger.debug(f'Fetching {page_url} page')
+    page_body, encoding = body(get_response_with_retry(page_url))
+    bytes_received.inc(len(page_body), 'fetch_page')
+    return [(page_url, page_body, encoding)]
+
+
+async def async_fetch_page(page_url, session):
+    logger.debug(f'Fetching {page_url} page')
+    response = await async_get_response_with_retry(page_url, session)
+    page_body, encoding = await async_body(response)
+    bytes_received.inc(len(page_body), 'fetch_page')
+    return [(page_url, page_body, encoding)]
+
+
+def tag_url(tag):
+    return urljoin(SITE_BASE_URL, f"you/tags/{quote(tag)}/")
+
+
+def page_tag(page_url):
+    """Tag of a listing page url"""
+    return unquote(re.search('/tags/([^/]+)/', urlsplit(page_url).path).group(1))
+
+
+def normalize_url(url):
+    """One key per book: lower case scheme and host, trailing slash, no fragment, the rest as the site wrote it"""
+    parts = urlsplit(url)
+    path = parts.path if parts.path.endswith('/') else parts.path + '/'
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ''))
+
+
+def parse_page(page):
+    """(page url, body, encoding) -> (book url, book name, (tag,)) for every book of the page"""
+    page_url, page_body, encoding = page
+    logger.debug(f'Parsing {page_url} page')
+    tag = page_tag(page_url)
+    books = []
+    with tracer.span('parse page', 'parse', url=page_url):
+        links = extract.book_links(ipc.decode(page_body, encoding))
+    for name, href in links:
+        book_url = normalize_url(urljoin(SITE_BASE_URL, re.sub('/trans/$', '/', href)))
+        books.append((book_url, name.replace('\n', ' '), (tag,)))
+        manifest.listed(*books[-1][:2], tag=tag)
+    manifest.page_parsed(page_url)
+    return books
+
+
+def plan_book(book):
+    """
+    (book url, book name, tags) -> (book url, book dir, files to fetch), nothing for verified books
+
+    A book listed under several tags is planned once, every tag is recorded in the catalog.
+    """
+    book_url, book_name, tags = book
+    seen = planned.setdefault(book_url, set())
+    new_tags, first = set(tags) - seen, not seen
+    seen.update(tags)
+    if book_catalog is not None:
+        for tag in sorted(new_tags):
+            book_catalog.tag(book_url, tag)
+    if not first:
+        logger.debug(f"Skipping {book_url}, already planned, also tagged {', '.join(sorted(new_tags))}")
+        return []
+    book_dir = os.path.join(dump_dir, book_name)
+    if manifest.is_verified(book_url, book_dir):
+        logger.debug(f"Skipping {book_url}, already dumped")
+        return []
+    logger.debug(f"Dumping {book_url}")
+    with tracer.span('mkdir', 'io', path=book_dir):
+        output.prepare(book_dir)
+    files = tuple(name for name in (ABOUT_FILE_NAME, TEXT_FILE_NAME) if manifest.needs(book_url, book_dir, name))
+    return [(book_url, book_dir, files)]
+
+
+def fetch_about(book):
+    """(book url, book dir, files) -> (book url, book dir, about page body, encoding)"""
+    book_url, book_dir, files = book
+    if ABOUT_FILE_NAME not in files:
+        return []
+    about_body, encoding = body(get_response_with_retry(urljoin(book_url, "stats/")))
+    bytes_received.inc(len(about_body), 'fetch_about')
+    return [(book_url, book_dir, about_body, encoding)]
+
+
+async def async_fetch_about(book, session):
+    book_url, book_dir, files = book
+    if ABOUT_FILE_NAME not in files:
+        return []
+    response = await async_get_response_with_retry(urljoin(book_url, "stats/"), session)
+    about_body, encoding = await async_body(response)
+    bytes_received.inc(len(about_body), 'fetch_about')
+    return [(book_url, book_dir, about_body, encoding)]
+
+
+def about_text(book_url, about_body, encoding):
+    with tracer.span('parse about', 'parse', url=book_url):
+        about = 'URL - {url}\n'.format(url=book_url) + extract.about_text(ipc.decode(about_body, encoding))
+    manifest.fetched(book_url, ABOUT_FILE_NAME, len(about.encode('utf-8')))
+    return about
+
+
+def about_record(book_url, book_dir, about):
+    return dict(url=book_url, name=os.path.basename(book_dir), about=about)
+
+
+def write_about(about_page):
+    """(book url, book dir, about page body, encoding) -> catalog record"""
+    book_url, book_dir, about_body, encoding = about_page
+    logger.debug(f'Dumping about {book_dir}')
+    about = about_text(book_url, about_body, encoding)
+    with write_seconds.time(ABOUT_FILE_NAME), tracer.span('write', 'io', file=ABOUT_FILE_NAME):
+        path = output.path(book_dir, ABOUT_FILE_NAME)
+        with open(path, 'wt', encoding='utf-8') as f:
+            f.write(about)
+        output.commit(book_url, book_dir, ABOUT_FILE_NAME, path)
+    return [about_record(book_url, book_dir, about)]
+
+
+async def async_write_about(about_page, session):
+    book_url, book_dir, about_body, encoding = about_page
+    logger.debug(f'Dumping about {book_dir}')
+    about = about_text(book_url, about_body, encoding)
+    with write_seconds.time(ABOUT_FILE_NAME), tracer.span('write', 'io', file=ABOUT_FILE_NAME):
+        path = output.path(book_dir, ABOUT_FILE_NAME)
+        async with async_open(path, 'wt', encoding='utf-8') as f:
+            await f.write(about)
+        output.commit(book_url, book_dir, ABOUT_FILE_NAME, path)
+    return [about_record(book_url, book_dir, about)]
+
+
+def text_record(book_url, book_dir, response, size, digest, fetched_at, start):
+    etag, last_modified = validators(response)
+    return dict(
+        url=book_url, name=os.path.basename(book_dir), size=size, sha256=digest.hexdigest(), etag=etag,
+        last_modified=last_modified, fetched_at=fetched_at, fetch_seconds=time.perf_counter() - start,
+    )
+
+
+def fetch_text(book):
+    """Streams book file straight to disk, the body is never held in memory as a whole, -> catalog record"""
+    book_url, book_dir, files = book
+    if TEXT_FILE_NAME not in files:
+        return []
+    fetched_at, start, digest = time.time(), time.perf_counter(), hashlib.sha256()
+    writing = metrics.Stopwatch()  # only the writes, the download is the stage time
+    path = output.path(book_dir, TEXT_FILE_NAME, suffix)
+    # the connection goes back to the pool, or is dropped when the body was cut short
+    with get_response_with_retry(urljoin(book_url, ".txt"), stream=True) as response:
+        logger.debug(f'Dumping file {book_dir}')
+        with tracer.span('stream', 'io', file=TEXT_FILE_NAME) as streaming, open(path, 'wb') as f:
+            writer = compression.CompressedWriter(f, codec)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                with writing:
+                    writer.write(chunk)
+                digest.update(chunk)
+            with writing:
+                writer.close()
+            manifest.fetched(book_url, TEXT_FILE_NAME, f.tell())
+            streaming.args['bytes'] = writer.size
+    with writing, tracer.span('commit', 'io', file=TEXT_FILE_NAME):
+        output.commit(book_url, book_dir, TEXT_FILE_NAME, path)
+    write_seconds.observe(writing.elapsed, TEXT_FILE_NAME)
+    bytes_received.inc(writer.size, 'text')
+    return [text_record(book_url, book_dir, response, writer.size, digest, fetched_at, start)]
+
+
+async def async_fetch_text(book, session):
+    book_url, book_dir, files = book
+    if TEXT_FILE_NAME not in files:
+        return []
+    fetched_at, start, digest = time.time(), time.perf_counter(), hashlib.sha256()
+    response = await async_get_response_with_retry(urljoin(book_url, ".txt"), session)
+
+    logger.debug(f'Dumping file {book_dir}')
+    writing = metrics.Stopwatch()
+    path = output.path(book_dir, TEXT_FILE_NAME, suffix)
+    streaming = tracer.span('stream', 'io', file=TEXT_FILE_NAME)
+    try:
+        with streaming:
+            if codec is None:
+                async with async_open(path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        with writing:
+                            await f.write(chunk)
+                        digest.update(chunk)
+                    size = f.tell()
+                    manifest.fetched(book_url, TEXT_FILE_NAME, size)
+            else:
+                # compressed blocks are written by the loop as they come back from the compressor threads
+                with open(path, 'wb') as f:
+                    writer = compression.CompressedWriter(f, codec)
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        with writing:
+                            await writer.async_write(chunk)
+                        digest.update(chunk)
+                    with writing:
+                        await writer.async_close()
+                    size = writer.size
+                    manifest.fetched(book_url, TEXT_FILE_NAME, f.tell())
+            streaming.args['bytes'] = size
+    finally:
+        response.release()  # the connection goes back to the session's pool, also when writing failed
+    with writing, tracer.span('commit', 'io', file=TEXT_FILE_NAME):
+        output.commit(book_url, book_dir, TEXT_FILE_NAME, path)
+    write_seconds.observe(writing.elapsed, TEXT_FILE_NAME)
+    bytes_received.inc(size, 'text')
+    return [text_record(book_url, book_dir, response, size, digest, fetched_at, start)]
+
+
+def catalog_book(record):
+    """Catalog record -> nothing, rows are batched by the single writer in the coordinator"""
+    if book_catalog is not None:
+        book_catalog.add(record)
+    return []
+
+
+def index_text(record):
+    """Catalog record of result.txt -> nothing, the text is read back from the output and indexed in batches"""
+    if search_index is not None:
+        search_index.add(record)
+    return []
+
+
+def archive_text(record):
+    """Catalog record of result.txt -> nothing, a changed text becomes a new version in the history"""
+    if book_history is not None:
+        book_history.add(record)
+    return []
+
+
+def read_output(book_name, file_name):
+    return output.read(os.path.join(dump_dir, book_name), file_name)
+
+
+INLINE = 'inline'
+THREADS = 'threads'
+PROCESSES = 'processes'
+ASYNCIO = 'asyncio'
+PROCESSES_ASYNCIO = 'processes-asyncio'
+
+
+class Stage:
+
+    def __init__(self, name, func, async_func=None, downstream=(), backends=None):
+        self.name = name
+        self.func = func
+        self.async_func = async_func
+        self.downstream = downstream
+        self.backends = backends  # None for any
+
+    def call(self, item):
+        with stage_seconds.time(self.name), tracer.span(self.name, 'stage'):
+            return self.func(item)
+
+    async def call_async(self, item, session):
+        """Async version if the stage has one"""
+        if self.async_func is None:
+            return self.call(item)
+        with stage_seconds.time(self.name), tracer.span(self.name, 'stage'):
+            return await self.async_func(item, session)
+
+
+STAGES = {stage.name: stage for stage in (
+    Stage('fetch_page', fetch_page, async_fetch_page, downstream=('parse_page',)),
+    Stage('parse_page', parse_page, downstream=('books',)),
+    # the only stage reading the manifest, it must see what this run has already decided
+    Stage('books', plan_book, downstream=('fetch_about', 'text'), backends=(INLINE,)),
+    Stage('fetch_about', fetch_about, async_fetch_about, downstream=('write_about',)),
+    Stage('write_about', write_about, async_write_about, downstream=('catalog',)),
+    Stage('text', fetch_text, async_fetch_text, downstream=('catalog', 'index', 'history')),
+    Stage('catalog', catalog_book, backends=(INLINE,)),
+    Stage('index', index_text, backends=(INLINE,)),
+    Stage('history', archive_text, backends=(INLINE,)),
+)}
+
+stage_seconds = metrics.Histogram('dump_stage_seconds', 'Time of one item in a stage', 'stage', STAGES)
+write_seconds = metrics.Histogram(
+    'dump_write_seconds', 'Time writing and committing one file to the output', 'file', (ABOUT_FILE_NAME, TEXT_FILE_NAME),
+)
+bytes_received = metrics.Counter(
+    'dump_received_bytes_total', 'Body bytes received', 'stage', ('fetch_page', 'fetch_about', 'text'),
+)
+stage_in_flight = metrics.Gauge('dump_stage_in_flight', 'Items being worked on in a stage', 'stage', STAGES)
+queue_depth = metrics.Gauge('dump_queue_depth', 'Items waiting in the queue of a stage', 'stage', STAGES)
+
+
+def picklable(error):
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+    return error
+
+
+def run_batch(name, items):
+    """Runs a batch of items one by one in a worker process, exceptions are returned per item"""
+    results = []
+    for item in items:
+        try:
+            results.append(STAGES[name].call(item))
+        except Exception as e:
+            results.append(picklable(e))
+    return results
+
+
+worker_loop = None
+worker_session = None
+
+
+async def open_session():
+    return aiohttp.ClientSession(connector=limits.connector())
+
+
+def setup_async(dir_name, resume):
+    """Initializer of `processes-asyncio` workers: one event loop and one pooled session for the worker's lifetime"""
+    global worker_loop, worker_session
+    setup(dir_name, resume)
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+    worker_session = worker_loop.run_until_complete(open_session())
+    multiprocessing.util.Finalize(None, close_async, exitpriority=10)
+
+
+def close_async():
+    worker_loop.run_until_complete(worker_session.close())
+    limits.close_limiter(worker_loop)
+    worker_loop.close()
+
+
+async def call_async_batch(name, items):
+    stage = STAGES[name]
+
+    results = await asyncio.gather(*(stage.call_async(item, worker_session) for item in items), return_exceptions=True)
+    return [picklable(result) if isinstance(result, BaseException) else result for result in results]
+
+
+def run_async_batch(name, items):
+    """Runs a batch of items concurrently on the worker loop, exceptions are returned per item"""
+    return worker_loop.run_until_complete(call_async_batch(name, items))
+
+
+class Batcher:
+    """
+    Collects items of one stage into batches for a process pool
+
+    A batch leaves at once while a worker is idle, so a lightly loaded pool sees no added latency.
+    With all workers busy items pile up until `size` of them are there, a worker frees up or `timeout` passes.
+    """
+
+    def __init__(self, backend, name, size, timeout):
+        self.backend = backend
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.pending = []
+        self.timer = None
+        self.tasks = set()  # the loop keeps only weak references to tasks
+
+    async def call(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size or self.backend.idle():
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.timeout, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch):
+        try:
+            results = await self.backend.submit(self.name, [item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():  # the caller was cancelled
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """Waits for the batches still running"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class Inline:
+    """Runs in the coordinator thread, blocks the event loop while it works"""
+    name = INLINE
+    default_workers = 1
+    options = ('workers',)  # after the name in a placement, separated by ':'
+
+    def __init__(self, workers, pipeline):
+        self.workers = workers
+
+    async def call(self, stage, item):
+        return stage.call(item)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Threads(Inline):
+    name = THREADS
+    default_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def __init__(self, workers, pipeline):
+        super().__init__(workers, pipeline)
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def call(self, stage, item):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, stage.call, item)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class Processes(Threads):
+    """
+    Worker processes fed with batches of up to `batch_size` items, see `Batcher`
+
+    `workers` is the number of processes, up to `workers * batch_size` items are in flight.
+    Items and results are pickled by `ipc`, worker processes keep their own manifest.
+    """
+    name = PROCESSES
+    default_workers = os.cpu_count() or 1
+    options = ('workers', 'batch_size')
+    initializer = staticmethod(setup)
+    run_batch = staticmethod(run_batch)
+
+    def __init__(self, workers, pipeline, batch_size=PROCESS_BATCH_SIZE):
+        Inline.__init__(self, workers * batch_size, pipeline)
+        self.processes = workers
+        self.batch_size = batch_size
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=FORK, initializer=self.initializer, initargs=(pipeline.dump_dir, output.resume)
+        )
+        self.batchers = {}
+        self.in_flight = 0
+
+    def idle(self):
+        return self.in_flight < self.processes
+
+    async def submit(self, name, items):
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await ipc.submit(loop, self.executor, self.run_batch, name, items, len(items))
+        finally:
+            self.in_flight -= 1
+            for batcher in self.batchers.values():
+                if batcher.pending and self.idle():
+                    batcher.flush()
+
+    async def call(self, stage, item):
+        if stage.name not in self.batchers:
+            self.batchers[stage.name] = Batcher(self, stage.name, self.batch_size, BATCH_TIMEOUT)
+        return await self.batchers[stage.name].call(item)
+
+    async def drain(self):
+        for batcher in self.batchers.values():
+            await batcher.close()
+
+
+class ProcessesAsyncIO(Processes):
+    """aiohttp inside worker processes, each with a persistent event loop and session, a batch runs concurrently"""
+    name = PROCESSES_ASYNCIO
+    initializer = staticmethod(setup_async)
+    run_batch = staticmethod(run_async_batch)
+
+
+class AsyncIO(Inline):
+    """aiohttp on the coordinator loop, stages without an async version run inline"""
+    name = ASYNCIO
+    default_workers = MAX_CONCURRENCY or 100
+
+    def __init__(self, workers, pipeline):
+        super().__init__(workers, pipeline)
+        self.pipeline = pipeline
+
+    async def call(self, stage, item):
+        if stage.async_func is None:
+            return stage.call(item)
+        return await stage.call_async(item, await self.pipeline.session())
+
+
+BACKENDS = {
+    INLINE: Inline,
+    THREADS: Threads,
+    PROCESSES: Processes,
+    ASYNCIO: AsyncIO,
+    PROCESSES_ASYNCIO: ProcessesAsyncIO,
+}
+
+
+def parse_placements(spec):
+    """'parse_page=processes:4,text=threads' -> {'parse_page': 'processes:4', 'text': 'threads'}"""
+    return dict(item.strip().split('=', 1) for item in spec.split(',') if item.strip())
+
+
+def make_backend(stage, placement, pipeline):
+    """
+    'threads:8' -> `Threads` backend with 8 workers, 'processes:4:32' -> 4 processes fed with batches of 32 items
+
+    Stages with the same placement share the backend.
+    """
+    name, *options = placement.split(':')
+    if name not in BACKENDS or (stage.backends and name not in stage.backends):
+        raise ValueError(f"Stage {stage.name} can't run on {name}")
+    if placement not in pipeline.backends:
+        backend = BACKENDS[name]
+        expected = ':'.join((name, ) + backend.options)
+        if len(options) > len(backend.options):
+            raise ValueError(f"Stage {stage.name} placement {placement} has too many options, expected {expected}")
+        if not all(option.isdigit() and int(option) > 0 for option in options if option):
+            raise ValueError(f"Stage {stage.name} placement {placement} needs positive integers, expected {expected}")
+        # an empty option keeps its default, 'processes::32' has the default number of processes
+        values = {key: int(option) for key, option in zip(backend.options, options) if option}
+        workers = values.pop('workers', backend.default_workers)
+        pipeline.backends[placement] = backend(workers, pipeline, **values)
+    return pipeline.backends[placement]
+
+
+STOP = object()
+PAGE_STAGES = ('fetch_page', 'parse_page')  # a failure loses every book of the page, the manifest keeps the page
+
+
+class Pipeline:
+
+    def __init__(self, dir_name, placements):
+        unknown = set(placements) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {', '.join(sorted(unknown))}, expected {', '.join(STAGES)}")
+        self.dump_dir = dir_name
+        self.placements = dict(placements)
+        self.backends = {}
+        self.failures = Counter()
+        self._session = None
+
+    async def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=limits.connector())
+        return self._session
+
+    async def run_stage(self, stage, backend, queues, upstreams):
+        """Runs until every one of `upstreams` stages has sent STOP"""
+        stops = 0
+
+        async def worker():
+            nonlocal stops
+            while True:
+                item = await queues[stage.name].get()
+                queue_depth.set(queues[stage.name].qsize(), stage.name)
+                if item is STOP:
+                    stops += 1
+                    if stops < upstreams:
+                        continue
+                    break
+                stage_in_flight.inc(stage.name)
+                try:
+                    results = await backend.call(stage, item)
+                except Exception:
+                    logger.exception(f"{stage.name} failed on {item if isinstance(item, str) else item[0]}")
+                    self.failures[stage.name] += 1
+                    if stage.name in PAGE_STAGES:
+                        manifest.page_failed(item if isinstance(item, str) else item[0])
+                    continue
+                finally:
+                    stage_in_flight.dec(stage.name)
+                for result in results:
+                    for name in stage.downstream:
+                        await queues[name].put(result)
+                        queue_depth.set(queues[name].qsize(), name)
+                # put() and get() only yield when a queue is full or empty, without this an inline stage
+                # would drain its whole queue before the next stage sees a single item
+                await asyncio.sleep(0)
+            await queues[stage.name].put(STOP)  # for the other workers of the stage
+
+        await asyncio.gather(*(worker() for _ in range(backend.workers)))
+        for name in stage.downstream:
+            await queues[name].put(STOP)
+
+    async def run(self, items, entry='fetch_page'):
+        """Feeds `items` to the `entry` stage, page urls by default"""
+        backends = {name: make_backend(stage, self.placements.get(name, INLINE), self) for name, stage in STAGES.items()}
+        queues = {name: asyncio.Queue(QUEUE_SIZE) for name in STAGES}
+        upstreams = Counter(name for stage in STAGES.values() for name in stage.downstream)
+        logger.debug('Pipeline: ' + ', '.join(
+            f"{name}={backend.name}:{backend.workers}" for name, backend in backends.items()
+        ))
+        try:
+            stages = [
+                asyncio.create_task(self.run_stage(stage, backends[name], queues, upstreams[name] or 1))
+                for name, stage in STAGES.items()
+            ]
+            for item in items:
+                await queues[entry].put(item)
+            # STOP reaches a later entry only after its items, through the stages before it
+            await queues['fetch_page'].put(STOP)
+            await asyncio.gather(*stages)
+        finally:
+            for backend in self.backends.values():
+                await backend.drain()
+                backend.close()
+            if self._session is not None:
+                await self._session.close()
+            limits.close_limiter(asyncio.get_running_loop())
+            output.close()
+        for name, count in self.failures.items():
+            logger.error(f"{count} items failed in {name}")
+        ipc.report()
+        return self.failures
+
+
+def tag_pages(tag):
+    """Listing pages of a tag"""
+    response = get_response_with_retry(tag_url(tag))
+    pager_links = extract.pager_links(response.text)
+    logger.debug(f"Found {len(pager_links) + 1} pages of {tag}")
+    return [tag_url(tag)] + [urljoin(SITE_BASE_URL, href) for _, href in pager_links]
+
+
+def page_urls():
+    """Listing pages of all tags, the first pages are fetched concurrently, and pages that failed in a resumed dump"""
+    with ThreadPoolExecutor(min(len(TAGS), MAX_CONCURRENCY or len(TAGS))) as executor:
+        pages = [page_url for pages in executor.map(tag_pages, TAGS) for page_url in pages]
+    # in case the pager no longer links them
+    return pages + [page_url for page_url in manifest.failed_pages() if page_url not in pages]
+
+
+def dump(dir_name, placements, items, entry='fetch_page'):
+    """Runs the pipeline over `items` with the single writers of this process around it, returns failures by stage"""
+    global book_catalog, search_index, book_history
+    # a book is planned once per call, a worker of a cluster gets its retried books in a later call
+    planned.clear()
+    if CATALOG:
+        book_catalog = catalog.Catalog(CATALOG)
+    if SEARCH_INDEX:
+        search_index = search.SearchIndex(SEARCH_INDEX, dir_name, read_output)
+    if HISTORY_DIR:
+        book_history = history.History(HISTORY_DIR, dir_name, read_output)
+    try:
+        return asyncio.run(Pipeline(dir_name, placements).run(items, entry))
+    finally:
+        # after the pipeline, every worker has flushed its output
+        for writer in (book_catalog, search_index, book_history):
+            if writer is not None:
+                writer.close()
+        book_catalog = search_index = book_history = None
+
+
+def run(dir_name, placements):
+    """True when every listed book is verified and nothing failed"""
+    connections.install_dns_cache()
+    if not checks(SITE_BASE_URL, dir_name):
+        return False
+    logger.debug('Checks passed')
+
+    os.makedirs(dir_name, exist_ok=RESUME)
+    logger.debug('Dump directory created')
+    outputs.recover(dir_name)
+    tracer.start()
+    setup(dir_name)
+
+    failures = dump(dir_name, placements, page_urls())
+    complete = manifest.complete()
+    if len(TAGS) > 1:
+        shared = sum(len(tags) > 1 for tags in planned.values())
+        logger.info(f"{len(planned)} books in {len(TAGS)} tags, {shared} listed under more than one tag, fetched once")
+    metrics.write(dir_name)
+    tracer.write()
+    return complete and not failures
+
+
+def main(variant='pipeline', preset=None):
+    """Runs a preset, `DUMP_PIPELINE` placements win over it"""
+    start = datetime.datetime.now()
+    logger.info('Start')
+    ok = run(f"{DUMP_NAME}_{TIMESTAMP}_{variant}", dict(preset or {}, **parse_placements(PIPELINE)))
+    http_cache.report()
+    connections.report()
+    compression.report()
+    blobs.report()
+    limits.report()
+    retry.report()
+    metrics.report()
+    logger.info(f"Done in {datetime.datetime.now() - start}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
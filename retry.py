@@ -0,0 +1,171 @@
+"""
+Retry policy shared by all variants, the same for `requests` and `aiohttp`
+
+Exponential backoff with full jitter, `Retry-After` is honoured, and every retry spends one unit
+of a per-run budget shared with forked pool processes, so a dead site fails fast instead of retrying forever.
+"""
+import time
+import random
+import asyncio
+import datetime
+import multiprocessing
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+
+import limits
+import metrics
+import tracer
+import http_cache
+from logger import get_logger
+from settings import RETRY_ATTEMPTS, BACKOFF_BASE, BACKOFF_CAP, RETRY_BUDGET, REQUEST_TIMEOUT
+
+logger = get_logger(__name__)
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+RETRY_EXCEPTIONS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+budget_spent = multiprocessing.Value('q', 0)
+retries = metrics.Counter(
+    'dump_retries_total', 'Retries by the status of the failed try, error for exceptions',
+    'status', [*map(str, sorted(RETRY_STATUSES)), 'error', 'other'],
+)
+requests_in_flight = metrics.Gauge('dump_requests_in_flight', 'Requests waiting for response headers')
+
+
+class RetryError(Exception):
+    """Request failed for good, `attempts` holds the outcome and the delay of every try"""
+
+    def __init__(self, url, attempts, reason='too many retries'):
+        self.url = url
+        self.attempts = attempts
+        self.reason = reason
+        history = ', '.join(str(attempt['outcome']) for attempt in attempts)
+        super().__init__(f"{url}: {reason} ({history})")
+
+    def __reduce__(self):  # crosses process pool boundaries
+        return type(self), (self.url, self.attempts, self.reason)
+
+
+def parse_retry_after(value):
+    """`Retry-After` header as seconds, it is either a number or an HTTP date"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, base=BACKOFF_BASE, cap=BACKOFF_CAP, budget=RETRY_BUDGET,
+                 statuses=RETRY_STATUSES, exceptions=RETRY_EXCEPTIONS, max_retry_after=300):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+        self.statuses = statuses
+        self.exceptions = exceptions
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, retry_after=None):
+        """Full jitter: uniform between zero and the exponential backoff, `Retry-After` wins if given"""
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def spend_budget(self):
+        with budget_spent.get_lock():
+            if self.budget and budget_spent.value >= self.budget:
+                return False
+            budget_spent.value += 1
+            return True
+
+    def next_delay(self, url, attempts, attempt, outcome, retry_after=None):
+        """Records the attempt, returns how long to sleep or raises `RetryError` if it was the last one"""
+        retryable = not isinstance(outcome, int) or outcome in self.statuses
+        delay = self.delay(attempt, retry_after) if retryable else None
+        attempts.append({'attempt': attempt + 1, 'outcome': outcome, 'delay': delay})
+        if not retryable:
+            raise RetryError(url, attempts, f"status {outcome} is not retried")
+        if attempt + 1 >= self.attempts:
+            raise RetryError(url, attempts)
+        if not self.spend_budget():
+            raise RetryError(url, attempts, 'retry budget exhausted')
+        status = str(outcome) if isinstance(outcome, int) else 'error'
+        retries.inc(label=status if status in retries.index else 'other')
+        logger.warning(f"{url} returned {outcome}, retry in {delay:.2f}s")
+        return delay
+
+
+default_policy = RetryPolicy()
+
+
+def get_response_with_retry(url, stream=False, policy=default_policy):
+    """GET through cache and limits, returns 200 response or raises `RetryError`"""
+    attempts = []
+    for attempt in range(max(1, policy.attempts)):
+        retry_after = None
+        try:
+            with limits.sync_request_slot(url) as slot:
+                requests_in_flight.inc()
+                try:
+                    with tracer.span('GET', 'http', url=url, attempt=attempt + 1) as request:
+                        response = http_cache.get(url, stream=stream, timeout=REQUEST_TIMEOUT)
+                        request.args['status'] = response.status_code
+                finally:
+                    requests_in_flight.dec()
+                slot.status = response.status_code
+        except policy.exceptions as e:
+            outcome = repr(e)
+        else:
+            if response.status_code == requests.codes.ok:
+                return response
+            outcome = response.status_code
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            response.close()
+        time.sleep(policy.next_delay(url, attempts, attempt, outcome, retry_after))
+
+
+async def async_get_response_with_retry(url, session, policy=default_policy):
+    """aiohttp twin of `get_response_with_retry`"""
+    attempts = []
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    for attempt in range(max(1, policy.attempts)):
+        retry_after = None
+        try:
+            async with limits.request_slot(url) as slot:
+                requests_in_flight.inc()
+                try:
+                    with tracer.span('GET', 'http', url=url, attempt=attempt + 1) as request:
+                        response = await http_cache.async_get(url, session, timeout=timeout)
+                        request.args['status'] = response.status
+                finally:
+                    requests_in_flight.dec()
+                slot.status = response.status
+        except policy.exceptions as e:
+            outcome = repr(e)
+        else:
+            if response.status == 200:
+                return response
+            outcome = response.status
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            response.release()
+        await asyncio.sleep(policy.next_delay(url, attempts, attempt, outcome, retry_after))
+
+
+def report():
+    if budget_spent.value:
+        logger.info(f"{budget_spent.value} retries spent{f' of {RETRY_BUDGET}' if RETRY_BUDGET else ''}")
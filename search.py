@@ -0,0 +1,140 @@
+"""
+Full-text search over dumped translations
+
+`DUMP_SEARCH_INDEX=search.sqlite` makes every run add its `result.txt` files to one SQLite FTS5 index
+shared by all dumps. A book is reindexed only when the sha256 of its text changed since it was last indexed,
+so a daily dump touches just the new and changed books.
+
+    python search.py search.sqlite "французских булок" --limit 5
+"""
+import sys
+import time
+import sqlite3
+import argparse
+
+from logger import get_logger
+from manifest import TEXT_FILE_NAME
+
+logger = get_logger(__name__)
+
+BATCH_SIZE = 50  # texts indexed per transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    url TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    sha256 TEXT,
+    dump TEXT,
+    indexed_at REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(name, body, tokenize = 'unicode61 remove_diacritics 2');
+"""
+
+SEARCH = """
+SELECT documents.name, documents.url, documents.dump,
+       snippet(texts, 1, '[', ']', '...', 16), bm25(texts, 10.0, 1.0) AS rank
+FROM texts JOIN documents ON documents.id = texts.rowid
+WHERE texts MATCH ? ORDER BY rank LIMIT ?
+"""
+
+
+def decode_text(body):
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body.decode('cp1251', 'replace')
+
+
+class SearchIndex:
+    """
+    Single writer, fed with catalog records of result.txt
+
+    `read(book_name, file_name)` returns a written file, OSError while it is not in the output yet;
+    such records wait for the next flush, `close` runs after every worker has finished writing.
+    """
+
+    def __init__(self, path, dump, read=None):
+        self.path = path
+        self.dump = dump
+        self.read = read
+        self.connection = sqlite3.connect(path, timeout=30)  # cluster workers take turns writing
+        # the rollback journal works over network filesystems, WAL needs memory shared on one host
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pending = []
+        self.indexed = self.unchanged = 0
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def is_indexed(self, record):
+        row = self.connection.execute("SELECT sha256 FROM documents WHERE url = ?", (record['url'],)).fetchone()
+        return row is not None and row[0] == record['sha256']
+
+    def flush(self):
+        waiting = []
+        with self.connection:
+            for record in self.pending:
+                if self.is_indexed(record):
+                    self.unchanged += 1
+                    continue
+                try:
+                    body = self.read(record['name'], TEXT_FILE_NAME)
+                except OSError:
+                    waiting.append(record)
+                    continue
+                self.index(record, decode_text(body))
+        self.pending = waiting
+
+    def index(self, record, text):
+        row = self.connection.execute(
+            "INSERT INTO documents (url, name, sha256, dump, indexed_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET name = excluded.name, sha256 = excluded.sha256, "
+            "dump = excluded.dump, indexed_at = excluded.indexed_at RETURNING id",
+            (record['url'], record['name'], record['sha256'], self.dump, time.time()),
+        ).fetchone()
+        self.connection.execute("DELETE FROM texts WHERE rowid = ?", row)
+        self.connection.execute("INSERT INTO texts (rowid, name, body) VALUES (?, ?, ?)", (row[0], record['name'], text))
+        self.indexed += 1
+
+    def close(self):
+        self.flush()
+        for record in self.pending:
+            logger.warning(f"Not indexed {record['url']}, no result.txt in the output")
+        self.connection.close()
+        logger.info(f"Search index: {self.indexed} texts indexed, {self.unchanged} unchanged, {self.path}")
+
+
+def search(path, query, limit=10):
+    """Ranked hits as (name, url, dump, snippet, rank), best first"""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return connection.execute(SEARCH, (query, limit)).fetchall()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('index', help='path to the search index')
+    parser.add_argument('query', help='FTS5 query: words, "a phrase", prefix*, a OR b, NEAR(a b)')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        hits = search(args.index, args.query, args.limit)
+    except sqlite3.OperationalError as e:
+        sys.exit(f"Search failed: {e}")
+    elapsed = time.perf_counter() - start
+    for name, url, dump, snippet, rank in hits:
+        print(f"{rank:9.4f}  {name}  {url}  ({dump})\n          {' '.join(snippet.split())}")
+    print(f"{len(hits)} hits in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
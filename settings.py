@@ -0,0 +1,50 @@
+import os
+import datetime
+
+SITE_BASE_URL = os.environ.get('DUMP_SITE_BASE_URL', 'https://translatedby.com/')
+TIMESTAMP = os.environ.get('DUMP_TIMESTAMP') or datetime.datetime.now().strftime('%Y-%m-%d')
+RESUME = os.environ.get('DUMP_RESUME', '') == '1'  # continue existing dump directory, skip verified books
+HTTP_CACHE_DIR = os.environ.get('DUMP_HTTP_CACHE_DIR', '')  # conditional-GET cache kept between runs, off if empty
+CHUNK_SIZE = int(os.environ.get('DUMP_CHUNK_SIZE', 64 * 1024))  # result.txt is streamed to disk by chunks of this size
+MAX_CONCURRENCY = int(os.environ.get('DUMP_MAX_CONCURRENCY', 100))  # requests in flight per event loop, 0 for no limit
+MAX_PER_HOST = int(os.environ.get('DUMP_MAX_PER_HOST', 20))  # open connections per host, 0 for no limit
+MAX_RPS = float(os.environ.get('DUMP_MAX_RPS', 0))  # requests per second to the site from all processes, 0 for no limit
+ADAPTIVE = os.environ.get('DUMP_ADAPTIVE', '') == '1'  # AIMD controlled requests in flight, capped by MAX_CONCURRENCY
+ADAPTIVE_START = int(os.environ.get('DUMP_ADAPTIVE_START', 4))
+RETRY_ATTEMPTS = int(os.environ.get('DUMP_RETRY_ATTEMPTS', 5))  # tries per request, the first one included
+BACKOFF_BASE = float(os.environ.get('DUMP_BACKOFF_BASE', 0.5))  # seconds, doubled on every retry, full jitter
+BACKOFF_CAP = float(os.environ.get('DUMP_BACKOFF_CAP', 30))
+RETRY_BUDGET = int(os.environ.get('DUMP_RETRY_BUDGET', 1000))  # retries per run over all workers, 0 for no limit
+REQUEST_TIMEOUT = float(os.environ.get('DUMP_REQUEST_TIMEOUT', 60))  # connect / read timeout, seconds
+HTML_BACKEND = os.environ.get('DUMP_HTML_BACKEND', 'auto')  # selectolax, lxml, stdlib or bs4, auto for the fastest installed
+PIPELINE = os.environ.get('DUMP_PIPELINE', '')  # stage placements over the preset, e.g. parse_page=processes:4,text=threads
+QUEUE_SIZE = int(os.environ.get('DUMP_QUEUE_SIZE', 100))  # items waiting between two pipeline stages
+KEEP_ALIVE = os.environ.get('DUMP_KEEP_ALIVE', '1') == '1'  # pooled sessions per thread, 0 for a connection per request
+POOL_CONNECTIONS = int(os.environ.get('DUMP_POOL_CONNECTIONS', 10))  # hosts with a connection pool per session
+POOL_MAXSIZE = int(os.environ.get('DUMP_POOL_MAXSIZE', 10))  # idle connections kept per host and session
+DNS_CACHE_TTL = int(os.environ.get('DUMP_DNS_CACHE_TTL', 300))  # seconds, 0 to resolve on every connection
+PROCESS_BATCH_SIZE = int(os.environ.get('DUMP_PROCESS_BATCH_SIZE', 16))  # max items per process pool task
+BATCH_TIMEOUT = float(os.environ.get('DUMP_BATCH_TIMEOUT', 0.05))  # seconds a partial batch waits for more items
+IPC_SPOOL_THRESHOLD = int(os.environ.get('DUMP_IPC_SPOOL_THRESHOLD', 256 * 1024))  # bodies this large reach workers via mmap, 0 never
+OUTPUT = os.environ.get('DUMP_OUTPUT', 'dirs')  # dirs for a directory per book, pack for one books.pack file with an index, blobs
+PACK_BATCH_BYTES = int(os.environ.get('DUMP_PACK_BATCH_BYTES', 1024 * 1024))  # pending bytes appended to the pack in one run
+PACK_FLUSH_INTERVAL = float(os.environ.get('DUMP_PACK_FLUSH_INTERVAL', 1))  # max seconds a file waits, checked on the next write
+CATALOG = os.environ.get('DUMP_CATALOG', 'catalog.sqlite')  # a row per book, shared by all dumps like the search index, off if empty
+CATALOG_BATCH_SIZE = int(os.environ.get('DUMP_CATALOG_BATCH_SIZE', 100))  # rows upserted per transaction
+SEARCH_INDEX = os.environ.get('DUMP_SEARCH_INDEX', '')  # full-text index shared by all dumps, e.g. search.sqlite, off if empty
+COMPRESSION = os.environ.get('DUMP_COMPRESSION', '')  # gzip, zstd or xz for result.txt, off if empty
+COMPRESSION_LEVEL = int(os.environ.get('DUMP_COMPRESSION_LEVEL', 0))  # 0 for the codec default
+COMPRESSION_WORKERS = int(os.environ.get('DUMP_COMPRESSION_WORKERS', os.cpu_count() or 1))  # compressor threads per process
+BLOB_DIR = os.environ.get('DUMP_BLOB_DIR', 'blobs')  # content-addressed store of DUMP_OUTPUT=blobs, on the filesystem of the dumps
+HISTORY_DIR = os.environ.get('DUMP_HISTORY_DIR', '')  # versions of every result.txt as bases and line deltas, shared by dumps, off if empty
+HISTORY_REBASE = int(os.environ.get('DUMP_HISTORY_REBASE', 8))  # deltas after a base before a full version is stored again
+METRICS_TEXTFILE = os.environ.get('DUMP_METRICS_TEXTFILE', '')  # Prometheus textfile, e.g. /var/lib/node_exporter/dump.prom, off if empty
+LOG_LEVEL = os.environ.get('DUMP_LOG_LEVEL', 'DEBUG').upper()
+LOG_FORMAT = os.environ.get('DUMP_LOG_FORMAT', 'text')  # text or json, one object per line
+LOG_DEBUG_SAMPLE = int(os.environ.get('DUMP_LOG_DEBUG_SAMPLE', 1))  # keep every N-th DEBUG record of a logging call, 1 for all
+TRACE = os.environ.get('DUMP_TRACE', '')  # Chrome trace event file of the run, e.g. trace.json, off if empty
+QUEUE_LEASE = float(os.environ.get('DUMP_QUEUE_LEASE', 60))  # seconds a claimed task stays with a worker without a heartbeat
+QUEUE_ATTEMPTS = int(os.environ.get('DUMP_QUEUE_ATTEMPTS', 3))  # claims of a task before it is failed for good
+QUEUE_POLL = float(os.environ.get('DUMP_QUEUE_POLL', 1))  # seconds between looks at the queue of an idle worker
+WORKER_BATCH = int(os.environ.get('DUMP_WORKER_BATCH', 20))  # books a cluster worker claims at once
+TAGS = [tag.strip() for tag in os.environ.get('DUMP_TAGS', 'GURPS').split(',') if tag.strip()]  # tags crawled in one run, comma separated
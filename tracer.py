@@ -0,0 +1,164 @@
+"""
+Timeline of a run in the Chrome trace event format
+
+`DUMP_TRACE=trace.json` records a span for every stage call, HTTP request, parse, mkdir and file write,
+with the process, thread and asyncio task it ran on. Open the file in https://ui.perfetto.dev or chrome://tracing
+to see idle workers, starved executors and stages waiting on each other.
+
+Every process buffers its spans and appends them to `<trace>.<pid>.part`, pool workers when they exit,
+the coordinator merges the parts into the trace at the end of the run. Spans of an asyncio task get a lane
+of their own under the thread of its loop, concurrent tasks would not nest on one lane. Off, `span` costs a function call.
+"""
+import os
+import glob
+import json
+import time
+import weakref
+import asyncio
+import itertools
+import threading
+import multiprocessing.util
+
+from logger import get_logger
+from settings import TRACE
+
+logger = get_logger(__name__)
+
+FLUSH_EVENTS = 10000  # buffered spans written to the part file at once
+TASK_LANES = 10 ** 7  # task lanes are numbered above any thread id of the kernel
+
+_events = []
+_events_lock = threading.Lock()  # guards _events and _names, flush may run on any thread
+_names = {}  # lane -> thread or task name
+_lanes = weakref.WeakKeyDictionary()  # task -> lane
+_lane_numbers = itertools.count(TASK_LANES)
+_pid = None
+_trace = TRACE  # trace file of this run, set by `start`, processes forked later inherit it
+
+
+def now():
+    """Microseconds of the monotonic clock, shared by all processes of a host"""
+    return time.monotonic_ns() // 1000
+
+
+def lane():
+    """Thread id, or the lane of the asyncio task running on this thread"""
+    thread_id = threading.get_native_id()
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        if thread_id not in _names:
+            with _events_lock:
+                _names[thread_id] = threading.current_thread().name
+        return thread_id
+    if task not in _lanes:
+        with _events_lock:
+            _lanes[task] = next(_lane_numbers)
+            _names[_lanes[task]] = f"{threading.current_thread().name} {task.get_name()}"
+    return _lanes[task]
+
+
+def part_path(pid):
+    return f"{_trace}.{pid}.part"
+
+
+def flush():
+    global _events
+    with _events_lock:
+        events, _events = _events, []
+        names = dict(_names)
+    if not events:
+        return
+    metadata = [
+        dict(ph='M', name='thread_name', pid=os.getpid(), tid=tid, args=dict(name=name)) for tid, name in names.items()
+    ]
+    metadata.append(dict(ph='M', name='process_name', pid=os.getpid(), args=dict(name=multiprocessing.current_process().name)))
+    with open(part_path(os.getpid()), 'at', encoding='utf-8') as f:
+        f.writelines(json.dumps(event, ensure_ascii=False) + '\n' for event in events + metadata)
+
+
+def record(event):
+    global _pid
+    if _pid != os.getpid():  # first span of a process, forked ones inherit the parent's buffer
+        _pid = os.getpid()
+        _events.clear()
+        _names.clear()
+        _lanes.clear()
+        multiprocessing.util.Finalize(None, flush, exitpriority=1)
+    with _events_lock:
+        _events.append(event)
+        full = len(_events) >= FLUSH_EVENTS
+    if full:
+        flush()
+
+
+class Span:
+    """Complete event from `__enter__` to `__exit__`, args set on the span until then are recorded with it"""
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.lane = lane()
+        self.start = now()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        record(dict(
+            ph='X', name=self.name, cat=self.cat, ts=self.start, dur=now() - self.start,
+            pid=os.getpid(), tid=self.lane, args=self.args,
+        ))
+
+
+class NoSpan:
+    """Stands in for a span when tracing is off, args set on it are dropped"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    @property
+    def args(self):
+        return {}
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name, cat='', **args):
+    """Context manager timing a block, `with tracer.span('GET', 'http', url=url) as s: ...; s.args['status'] = 200`"""
+    if not _trace:
+        return NO_SPAN
+    return Span(name, cat, args)
+
+
+def start(path=TRACE):
+    """Traces into `path`, off if empty, removes parts left by an interrupted run, called before any span"""
+    global _trace
+    _trace = path
+    for part in glob.glob(part_path('*')) if path else ():
+        os.remove(part)
+
+
+def write():
+    """Merges the parts of all processes into the trace, called by the coordinator after the pools are gone"""
+    if not _trace:
+        return
+    flush()
+    events = []
+    for path in glob.glob(part_path('*')):
+        with open(path, 'rt', encoding='utf-8') as f:
+            events.extend(json.loads(line) for line in f if line.endswith('\n'))
+        os.remove(path)
+    with open(_trace + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f, ensure_ascii=False)
+    os.replace(_trace + '.tmp', _trace)
+    logger.info(f"Trace: {sum(event['ph'] == 'X' for event in events)} spans in {_trace}")
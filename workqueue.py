@@ -0,0 +1,188 @@
+"""
+Durable work queue of a sharded dump
+
+A SQLite file with one row per task. Workers claim tasks with a lease of `DUMP_QUEUE_LEASE` seconds and keep it
+with heartbeats, a task whose lease runs out (the worker died or hangs) is claimed by the next worker that asks.
+After `DUMP_QUEUE_ATTEMPTS` claims a task is failed for good. Claims run in `BEGIN IMMEDIATE` transactions,
+so two workers never get the same task.
+
+    python workqueue.py status GURPS_2024-01-31_cluster.queue
+    python workqueue.py retry GURPS_2024-01-31_cluster.queue
+
+Every worker must open the same file, on one host or through a filesystem with working POSIX locks.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+from logger import get_logger
+from settings import QUEUE_LEASE, QUEUE_ATTEMPTS
+
+logger = get_logger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, LEASED, DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class WorkQueue:
+    """Tasks are a unique key and a json payload, one connection per thread"""
+
+    def __init__(self, path, lease=QUEUE_LEASE, attempts=QUEUE_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.attempts = attempts
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        # the rollback journal works over network filesystems, WAL needs memory shared on one host
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def transaction(self):
+        """Write transaction taken at once, a claim must not read rows another worker is about to take"""
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+    def set(self, name, value):
+        self.connection.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, json.dumps(value)),
+        )
+
+    def get(self, name, default=None):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, tasks):
+        """Adds (key, payload) pairs, keys already in the queue are left as they are, returns the number added"""
+        now = time.time()
+        with self.transaction():
+            cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO tasks (key, payload, updated_at) VALUES (?, ?, ?)",
+                [(key, json.dumps(payload, ensure_ascii=False), now) for key, payload in tasks],
+            )
+        return cursor.rowcount
+
+    def claim(self, owner, limit):
+        """Up to `limit` pending tasks or tasks with an expired lease, as dicts with id, key, payload and attempts"""
+        now = time.time()
+        with self.transaction():
+            expired = self.connection.execute(
+                "UPDATE tasks SET state = ?, error = 'lease expired', updated_at = ? "
+                "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.attempts),
+            ).rowcount
+            rows = self.connection.execute(
+                "SELECT id, key, payload, attempts, state, owner FROM tasks "
+                "WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY id LIMIT ?",
+                (PENDING, LEASED, now, limit),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE tasks SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                [(LEASED, owner, now + self.lease, now, row[0]) for row in rows],
+            )
+        if expired:
+            logger.warning(f"{expired} tasks failed, their leases expired {self.attempts} times")
+        for _, key, _, _, state, previous in rows:
+            if state == LEASED:
+                logger.warning(f"Lease of {key} by {previous} expired, reassigned to {owner}")
+        return [dict(id=row[0], key=row[1], payload=json.loads(row[2]), attempts=row[3] + 1) for row in rows]
+
+    def heartbeat(self, owner, ids):
+        """Extends the leases of `owner`, returns how many it still holds"""
+        if not ids:
+            return 0
+        now = time.time()
+        return self.connection.execute(
+            f"UPDATE tasks SET lease_until = ?, updated_at = ? "
+            f"WHERE owner = ? AND state = ? AND id IN ({', '.join('?' * len(ids))})",
+            (now + self.lease, now, owner, LEASED, *ids),
+        ).rowcount
+
+    def finish(self, owner, task_id, error=None):
+        """Done, or back to pending after an error until the attempts are used up, ignored if the lease was lost"""
+        if error is None:
+            query, params = "UPDATE tasks SET state = ?, error = NULL", (DONE,)
+        else:
+            query = "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, owner = NULL"
+            params = (self.attempts, FAILED, PENDING, error)
+        return self.connection.execute(
+            query + ", updated_at = ? WHERE id = ? AND owner = ? AND state = ?",
+            (*params, time.time(), task_id, owner, LEASED),
+        ).rowcount == 1
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.connection.execute("SELECT state, count(*) FROM tasks GROUP BY state").fetchall())
+        return counts
+
+    def unfinished(self):
+        return self.connection.execute("SELECT count(*) FROM tasks WHERE state IN (?, ?)", (PENDING, LEASED)).fetchone()[0]
+
+    def failed(self):
+        return self.connection.execute("SELECT key, attempts, error FROM tasks WHERE state = ?", (FAILED,)).fetchall()
+
+    def retry(self):
+        """Failed tasks go back to pending with fresh attempts, returns their number"""
+        return self.connection.execute(
+            "UPDATE tasks SET state = ?, attempts = 0, error = NULL, owner = NULL, updated_at = ? WHERE state = ?",
+            (PENDING, time.time(), FAILED),
+        ).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('status', 'retry'))
+    parser.add_argument('queue', help='queue file of a cluster dump')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.queue):
+        sys.exit(f"No queue {args.queue}")
+    queue = WorkQueue(args.queue)
+    try:
+        if args.command == 'status':
+            print(', '.join(f"{count} {state}" for state, count in queue.counts().items()))
+            for key, attempts, error in queue.failed():
+                print(f"failed after {attempts} attempts: {key} ({error})")
+        else:
+            print(f"{queue.retry()} failed tasks are pending again")
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()